@@ -0,0 +1,289 @@
+"""同時接続の負荷テスト（オフラインで実行）
+
+1つのサーバープロセスで何人の看護師が同時に使えるかを確かめるためのスクリプト。
+一時ディレクトリに合成した施設データ（CSV）と secrets.toml を用意し、Streamlit の AppTest で
+N 個のセッションをスレッドで同時に動かす（本番のサーバーも1プロセス内のスレッドで各セッションを実行する）。
+各セッションは「ログイン → 患者選択 → スコア保存 → ダッシュボード表示」を繰り返し、
+再実行の待ち時間（パーセンタイル）、セッションあたりのメモリ、ファイル書き込みの競合を表示する。
+
+使い方: python load_test.py --sessions 20 --facilities 2 --rounds 3
+"""
+import argparse
+import datetime
+import gc
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "my_first_app.py")
+MASTER_ID = "master_load_test"
+CONFLICT_MESSAGE_PREFIX = "他の端末で先に更新されたため"
+STEP_ORDER = ["初期表示", "ログイン", "患者選択", "項目スコア保存", "総合スコア保存", "ダッシュボード"]
+
+# --- 合成データ・secrets の用意 ---
+def make_stay(patient_id, start_date, days, status, disease_group, outcome, rng, app):
+    """1人分の入室期間（朝・夕）の記録を、スコアが回復していく形で作る"""
+    rows = []; n = days * 2; base = np.clip(np.linspace(rng.integers(5, 25), rng.integers(60, 100), n) + rng.normal(0, 5, n), 0, 100)
+    events = list(app.EVENT_FLAGS)
+    for i in range(n):
+        row = {"アプリ用患者ID": patient_id, "日付": str(start_date + datetime.timedelta(days=i // 2)), "時間帯": "朝" if i % 2 == 0 else "夕",
+               "総合スコア": int(base[i]), "ステータス": status, "疾患群": disease_group, "要因タグ": None,
+               "イベント": ", ".join(rng.choice(events, size=int(rng.integers(1, 3)), replace=False)) if rng.random() < 0.2 else None,
+               "退室時転帰": outcome if status == "退室済" and i == n - 1 else None}
+        row.update({name: int(np.clip(base[i] + rng.normal(0, 10), 0, 100)) for name in app.FACTOR_SCORE_NAMES})
+        rows.append(row)
+    return rows
+
+def make_facility_data(n_active, n_archived, rng, app):
+    """在室中・退室済の患者からなる施設データを作る。在室中の患者は昨日までの記録を持つ"""
+    today = datetime.date.today(); rows = []; disease_groups = app.DISEASE_OPTIONS[:3]
+    for i in range(n_active):
+        days = int(rng.integers(3, 15))
+        rows += make_stay(f"A{i:03d}", today - datetime.timedelta(days=days), days, "在室中", disease_groups[i % 3], None, rng, app)
+    for i in range(n_archived):
+        days = int(rng.integers(5, 30)); start = today - datetime.timedelta(days=int(rng.integers(40, 200)))
+        rows += make_stay(f"D{i:03d}", start, days, "退室済", disease_groups[i % 3], "軽快" if rng.random() < 0.85 else "死亡", rng, app)
+    return pd.DataFrame(rows).reindex(columns=app.ALL_COLUMN_NAMES)
+
+def prepare_workdir(work_dir, facilities, n_active, n_archived, seed, app):
+    """作業ディレクトリに施設ごとの患者データと secrets.toml を書き出す"""
+    rng = np.random.default_rng(seed)
+    for facility_id in facilities: make_facility_data(n_active, n_archived, rng, app).to_csv(os.path.join(work_dir, f"{app.DATA_FILE_PREFIX}{facility_id}.csv"), index=False)
+    os.makedirs(os.path.join(work_dir, ".streamlit"), exist_ok=True)
+    with open(os.path.join(work_dir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f'[master_credentials]\nid = "{MASTER_ID}"\npassword = "master_pw"\n\n[passwords]\n')
+        f.writelines(f'{facility_id} = "{facility_id}_pw"\n' for facility_id in facilities)
+
+# --- 計測 ---
+def get_rss_bytes():
+    """プロセスの現在の常駐メモリ（取れない環境では最大常駐メモリ）"""
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError): return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def get_session_state_bytes(at):
+    """セッションに保持している DataFrame・バイト列のおおよそのサイズ"""
+    total = 0
+    for value in at.session_state.values():
+        if isinstance(value, pd.DataFrame): total += int(value.memory_usage(deep=True).sum())
+        elif isinstance(value, (bytes, bytearray)): total += len(value)
+    return total
+
+class MemorySampler:
+    """計測中の常駐メモリを一定間隔で記録し、ピークを求める（図の描画中など一時的な確保も含める）"""
+    def __init__(self, interval=0.1):
+        self.interval = interval; self.samples = []; self.stop_event = threading.Event(); self.thread = threading.Thread(target=self.sample, name="memory-sampler", daemon=True)
+    def sample(self):
+        while not self.stop_event.is_set(): self.samples.append(get_rss_bytes()); self.stop_event.wait(self.interval)
+    def __enter__(self):
+        self.thread.start(); return self
+    def __exit__(self, *exc):
+        self.stop_event.set(); self.thread.join()
+
+class WriteRecorder:
+    """DataFrame のファイル書き出しを記録する（どのセッションが・どのファイルに・いつからいつまで）"""
+    def __init__(self):
+        self.lock = threading.Lock(); self.writes = []; self.originals = {}
+    def wrap(self, name):
+        original = getattr(pd.DataFrame, name); self.originals[name] = original; recorder = self
+        def recorded(df, path_or_buf=None, *args, **kwargs):
+            start = time.perf_counter(); result = original(df, path_or_buf, *args, **kwargs); end = time.perf_counter()
+            if isinstance(path_or_buf, (str, os.PathLike)):
+                with recorder.lock: recorder.writes.append({"ファイル": os.path.relpath(str(path_or_buf)), "開始": start, "終了": end})
+            return result
+        setattr(pd.DataFrame, name, recorded)
+    def __enter__(self):
+        self.wrap("to_csv"); self.wrap("to_parquet"); return self
+    def __exit__(self, *exc):
+        for name, original in self.originals.items(): setattr(pd.DataFrame, name, original)
+
+# --- セッションの操作 ---
+def share_app_test_globals():
+    """AppTest は1回の実行ごとに Runtime・スクリプトのキャッシュ・設定をプロセス全体で差し替えて戻すため、そのままでは
+    スレッドで同時に動かせない。本番のサーバーと同じく、全セッションで1つの Runtime とコンパイル済みのスクリプトを共有させる"""
+    from streamlit import config
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.logger import set_log_level
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    config.set_option("global.appTest", True)  # 実行ごとの設定の差し替えが、他のセッションの実行中に戻されないようにする
+    config.set_option("logger.level", "error"); set_log_level("error")
+    shared = {"runtime": None}; shared_script_cache = ScriptCache(); get_bytecode = ScriptCache.get_bytecode
+    def instance(cls):
+        shared["runtime"] = shared["runtime"] or cls._instance
+        if shared["runtime"] is None: raise RuntimeError("Runtime hasn't been created!")
+        return shared["runtime"]
+    Runtime.instance = classmethod(instance); Runtime.exists = classmethod(lambda cls: (shared["runtime"] or cls._instance) is not None)
+    ScriptCache.get_bytecode = lambda self, script_path: get_bytecode(shared_script_cache, script_path)
+
+def find_widget(widgets, label=None, key=None):
+    return next(w for w in widgets if (label is None or w.label == label) and (key is None or w.key == key))
+
+class NurseSession:
+    """1人の看護師の操作を AppTest で再現し、各ステップの再実行時間を記録する"""
+    def __init__(self, index, facility_id, patient_id, disease_group, args, results):
+        from streamlit.testing.v1 import AppTest
+        self.index = index; self.facility_id = facility_id; self.patient_id = patient_id; self.disease_group = disease_group; self.args = args; self.results = results
+        self.at = AppTest.from_file(APP_FILE, default_timeout=args.timeout); self.rng = random.Random(args.seed + index)
+
+    def step(self, name, action=None):
+        if self.args.think: time.sleep(self.rng.uniform(0, self.args.think))
+        start = time.perf_counter()
+        try:
+            if action: action()
+            self.at.run(); error = "; ".join(str(e.value) for e in self.at.exception)[:200] or None
+        except Exception as e: error = f"{type(e).__name__}: {e}"[:200]
+        end = time.perf_counter()
+        conflicts = sum(str(w.value).startswith(CONFLICT_MESSAGE_PREFIX) for w in self.at.warning) if error is None else 0
+        self.results.append({"セッション": self.index, "ステップ": name, "開始": start, "終了": end, "秒": end - start, "エラー": error, "競合": conflicts})
+        return error is None
+
+    def login(self):
+        self.step("初期表示")
+        def enter():
+            find_widget(self.at.text_input, label="施設ID").set_value(self.facility_id); find_widget(self.at.text_input, label="パスワード").set_value(f"{self.facility_id}_pw")
+            if self.args.client_charts: self.at.session_state["client_charts"] = True
+            find_widget(self.at.button, label="ログイン").click()
+        return self.step("ログイン", enter)
+
+    def work_round(self, round_index):
+        """患者を選んで、担当の項目スコア・総合スコアを記録し、ダッシュボードで比較する"""
+        factor_name = self.args.factor_names[(self.index + round_index) % len(self.args.factor_names)]
+        score = self.rng.randrange(0, 101)
+        def open_dashboard():
+            find_widget(self.at.selectbox, label="分析したい疾患群を選択してください").set_value(self.disease_group)
+            compare = find_widget(self.at.selectbox, label="比較したい治療中の患者を選択（任意）")
+            if self.patient_id in compare.options: compare.set_value(self.patient_id)  # 疾患群を切り替えた直後は、次の再実行で選べるようになる
+        steps = [
+            ("患者選択", lambda: find_widget(self.at.selectbox, label="表示・記録する患者IDを選択").set_value(self.patient_id)),
+            ("項目スコア保存", lambda: (find_widget(self.at.number_input, key=f"{factor_name}_number").set_value(score), find_widget(self.at.button, key=f"save_{factor_name}").click())),
+            ("総合スコア保存", lambda: (find_widget(self.at.number_input, key="total_score_number").set_value(score), find_widget(self.at.button, key="save_total_score").click())),
+            ("ダッシュボード", open_dashboard),
+        ]
+        for name, action in steps:
+            if not self.step(name, action): return False
+        return True
+
+    def run(self, start_barrier):
+        try:
+            start_barrier.wait()
+            if not self.login(): return
+            for round_index in range(self.args.rounds):
+                if not self.work_round(round_index): return
+        except Exception as e:  # ウィジェットが見つからない等、想定外の画面になった場合
+            self.results.append({"セッション": self.index, "ステップ": "中断", "開始": time.perf_counter(), "終了": time.perf_counter(), "秒": 0.0, "エラー": f"{type(e).__name__}: {e}"[:200], "競合": 0})
+
+def warm_up(facilities, args, app):
+    """施設ごとに1セッションで一通り操作して、退室済データのコールド移行・初回の事前計算・ライブラリの初期化を済ませておく（計測対象外）"""
+    for i, facility_id in enumerate(facilities):
+        session = NurseSession(-1 - i, facility_id, "A000", app.DISEASE_OPTIONS[0], args, [])
+        if session.login(): session.work_round(0)
+    time.sleep(args.settle); gc.collect()
+
+# --- 集計 ---
+def summarize_latency(results):
+    ok = results[results["エラー"].isna()]
+    table = ok.groupby("ステップ")["秒"].describe(percentiles=[0.5, 0.9, 0.99])[["count", "50%", "90%", "99%", "max"]]
+    table = table.reindex([s for s in STEP_ORDER if s in table.index]).rename(columns={"count": "回数"})
+    overall = ok["秒"].describe(percentiles=[0.5, 0.9, 0.99])[["count", "50%", "90%", "99%", "max"]].rename({"count": "回数"})
+    table.loc["全ステップ"] = overall
+    return table.assign(回数=table["回数"].astype(int))
+
+def summarize_writes(writes, results):
+    """ファイルごとの書き込み回数・時間と、書き込み中に他のセッションの保存が重なっていた数"""
+    if writes.empty: return pd.DataFrame()
+    saves = results[results["ステップ"].str.endswith("保存")]
+    def overlapping_saves(write):
+        # 書き込みはスクリプト実行用のスレッドで行われるため、重なった保存操作から自分の保存の1件を除いて数える
+        return max(int(((saves["開始"] < write["終了"]) & (saves["終了"] > write["開始"])).sum()) - 1, 0)
+    def overlapping_writes(group):
+        ordered = group.sort_values("開始"); return int((ordered["開始"].values[1:] < ordered["終了"].cummax().values[:-1]).sum())
+    writes = writes.assign(書込秒=writes["終了"] - writes["開始"], 並行保存=writes.apply(overlapping_saves, axis=1))
+    table = writes.groupby("ファイル").agg(回数=("書込秒", "size"), 合計秒=("書込秒", "sum"), 最大秒=("書込秒", "max"), 並行保存_平均=("並行保存", "mean"), 並行保存_最大=("並行保存", "max"))
+    table["同時書込"] = writes.groupby("ファイル").apply(overlapping_writes)
+    # コールド領域は患者ごとのファイルなので、施設単位にまとめて表示する
+    table.index = [os.path.dirname(path) if path.endswith(".parquet") else path for path in table.index]
+    return table.groupby(level=0).agg({"回数": "sum", "合計秒": "sum", "最大秒": "max", "並行保存_平均": "mean", "並行保存_最大": "max", "同時書込": "sum"}).sort_values("回数", ascending=False)
+
+def check_data_files(facilities, app):
+    """書き込み後の患者データが読めて、同じ記録（患者・日付・時間帯）が重複していないかを確かめる"""
+    rows = []
+    for facility_id in facilities:
+        df = pd.read_csv(f"{app.DATA_FILE_PREFIX}{facility_id}.csv")
+        rows.append({"施設": facility_id, "行数": len(df), "重複記録": int(df.duplicated(subset=app.RECORD_KEY_COLUMNS).sum())})
+    return pd.DataFrame(rows).set_index("施設")
+
+def main():
+    parser = argparse.ArgumentParser(description="Streamlit アプリの同時接続負荷テスト（オフライン）")
+    parser.add_argument("--sessions", type=int, default=10, help="同時セッション数")
+    parser.add_argument("--facilities", type=int, default=2, help="施設数（セッションは施設に均等に割り振る）")
+    parser.add_argument("--rounds", type=int, default=3, help="1セッションあたりの「患者選択→保存→ダッシュボード」の繰り返し回数")
+    parser.add_argument("--active-patients", type=int, default=10, help="施設ごとの在室中患者数")
+    parser.add_argument("--archived-patients", type=int, default=40, help="施設ごとの退室済患者数")
+    parser.add_argument("--nurses-per-patient", type=int, default=2, help="同じ患者を同時に記録するセッション数")
+    parser.add_argument("--think", type=float, default=0.5, help="操作の間の待ち時間の上限（秒）")
+    parser.add_argument("--settle", type=float, default=2.0, help="ウォームアップ後に事前計算の完了を待つ時間（秒）")
+    parser.add_argument("--timeout", type=float, default=300, help="1回の再実行のタイムアウト（秒）")
+    parser.add_argument("--client-charts", action="store_true", help="グラフをブラウザ描画モードにする")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="作業ディレクトリを消さずに残す")
+    args = parser.parse_args()
+
+    # secrets.toml はカレントディレクトリから読まれるので、streamlit を読み込む前に作業ディレクトリへ移動する
+    original_dir = os.getcwd(); work_dir = tempfile.mkdtemp(prefix="load_test_"); os.chdir(work_dir)
+    from streamlit.logger import set_log_level
+    set_log_level("error"); sys.path.insert(0, os.path.dirname(APP_FILE)); import my_first_app as app
+    share_app_test_globals(); warnings.filterwarnings("ignore", message="Glyph .* missing from font")  # 日本語フォントが無い環境の警告は表示しない
+    facilities = [f"load_facility_{i + 1}" for i in range(args.facilities)]; args.factor_names = app.FACTOR_SCORE_NAMES
+    prepare_workdir(work_dir, facilities, args.active_patients, args.archived_patients, args.seed, app)
+    print(f"作業ディレクトリ: {work_dir}\nセッション数: {args.sessions} / 施設数: {args.facilities} / 繰り返し: {args.rounds}\n")
+
+    try:
+        warm_up(facilities, args, app)
+        results = []; rss_before = get_rss_bytes()
+        # 同じ施設のセッションは、nurses_per_patient 人ずつ同じ在室中患者を受け持つ
+        patient_numbers = [(i // (len(facilities) * args.nurses_per_patient)) % args.active_patients for i in range(args.sessions)]
+        sessions = [NurseSession(i, facilities[i % len(facilities)], f"A{k:03d}", app.DISEASE_OPTIONS[k % 3], args, results) for i, k in enumerate(patient_numbers)]
+        barrier = threading.Barrier(len(sessions))
+        threads = [threading.Thread(target=s.run, args=(barrier,), name=f"session-{s.index}") for s in sessions]
+        with WriteRecorder() as recorder, MemorySampler() as memory:
+            started = time.perf_counter()
+            for t in threads: t.start()
+            for t in threads: t.join()
+            elapsed = time.perf_counter() - started
+        gc.collect(); rss_after = get_rss_bytes()
+
+        results = pd.DataFrame(results); writes = pd.DataFrame(recorder.writes)
+        errors = results[results["エラー"].notna()]
+        pd.set_option("display.width", 200); pd.set_option("display.float_format", "{:.3f}".format)
+        print("■ 再実行の待ち時間（秒）"); print(summarize_latency(results)); print()
+        print(f"処理した再実行: {len(results) - len(errors)}回 / {elapsed:.1f}秒（{(len(results) - len(errors)) / elapsed:.2f}回/秒）\n")
+        state_bytes = [get_session_state_bytes(s.at) for s in sessions]
+        print("■ メモリ")
+        peak_increase = max(memory.samples + [rss_after]) - rss_before
+        print(f"計測中のピーク: 開始時 +{peak_increase / 2**20:.1f} MiB（1セッションあたり {peak_increase / len(sessions) / 2**20:.2f} MiB、描画中の一時領域・スレッドごとの確保領域を含む）")
+        print(f"終了時: 開始時 {(rss_after - rss_before) / 2**20:+.1f} MiB（セッション状態・キャッシュとして残った分）")
+        print(f"セッション状態の DataFrame: 平均 {np.mean(state_bytes) / 2**20:.2f} MiB / 最大 {np.max(state_bytes) / 2**20:.2f} MiB\n")
+        print("■ ファイル書き込み（並行保存: 書き込み中に他のセッションの保存操作が重なっていた数、同時書込: 同じファイルへの書き込みが時間的に重なった回数）")
+        print(summarize_writes(writes, results)); print()
+        print(f"保存の競合（他の端末の更新と同じ項目がぶつかった回数）: {int(results['競合'].sum())}")
+        print(check_data_files(facilities, app)); print()
+        if errors.empty: print("エラー: なし")
+        else:
+            print(f"エラー: {len(errors)}件"); print(errors.groupby(["ステップ", "エラー"]).size().rename("件数").to_string())
+    finally:
+        os.chdir(original_dir)
+        if args.keep: print(f"作業ディレクトリを残しました: {work_dir}")
+        else: shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if not errors.empty else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,24 @@
 import streamlit as st
 import pandas as pd
 import datetime
+import time
 import os
+import io
 import glob
+import threading
+import json
+from functools import reduce
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.colors import to_rgba
+from matplotlib.patches import Patch
 import matplotlib.dates as mdates
 import numpy as np
 import seaborn as sns
+import pyarrow as pa
+import pyarrow.dataset as ds
 import matplotlib.font_manager as fm 
 
 # ★★★ フォント設定 ★★★
@@ -24,6 +36,9 @@ PHASE_COLORS = {
 }
 FACTOR_SCORE_NAMES = ["循環スコア", "呼吸スコア", "意識_鎮静スコア", "腎_体液スコア", "活動_リハスコア", "栄養_消化管スコア", "感染_炎症スコア"]
 ALL_COLUMN_NAMES = ["アプリ用患者ID", "日付", "時間帯", "総合スコア"] + FACTOR_SCORE_NAMES + ["イベント", "ステータス", "疾患群", "要因タグ", "退室時転帰"]
+SCORE_COLUMN_NAMES = ["総合スコア"] + FACTOR_SCORE_NAMES
+RECORD_KEY_COLUMNS = ["アプリ用患者ID", "日付", "時間帯"]
+SCORE_JUMP_THRESHOLD = 41  # 前回からこの点数以上変動したら注意を出す
 EVENT_FLAGS = {
     "入室": {"category": "#その他", "color": "red", "marker": "s"},"挿管": {"category": "#呼吸", "color": "darkred", "marker": "v"},"再手術": {"category": "#その他", "color": "darkred", "marker": "X"},
     "転棟": {"category": "#その他", "color": "blue", "marker": "s"},"抜管": {"category": "#呼吸", "color": "green", "marker": "^"},"再挿管": {"category": "#呼吸", "color": "red", "marker": "v"},
@@ -58,10 +73,7 @@ def calculate_derived_columns(df):
     df_copy['日付'] = pd.to_datetime(df_copy['日付'])
     
     # 1. 最初に、最も信頼性の高い「プロット用日時」列を作成します
-    df_copy['プロット用日時'] = df_copy.apply(
-        lambda row: row['日付'].replace(hour=8 if row['時間帯'] == '朝' else 20),
-        axis=1
-    )
+    df_copy['プロット用日時'] = make_plot_datetime(df_copy['日付'], df_copy['時間帯'])
     
     # 2. 作成した「プロット用日時」を基準に、データを完全に時系列順に並べ替えます
     df_copy = df_copy.sort_values(by='プロット用日時')
@@ -82,7 +94,7 @@ def calculate_derived_columns(df):
 
 def create_radar_chart(labels, current_data, previous_data=None, current_label='最新', previous_label='前回', current_color='blue', previous_color='red', current_style='-', previous_style='--'):
     num_vars = len(labels); angles = np.linspace(0, 2 * np.pi, num_vars, endpoint=False).tolist(); angles += angles[:1]
-    fig, ax = plt.subplots(figsize=(6, 6), subplot_kw=dict(polar=True))
+    fig = Figure(figsize=(6, 6)); ax = fig.add_subplot(polar=True)
     ax.bar(x=0, height=20, width=2*np.pi, bottom=80, color=PHASE_COLORS["転棟期"], alpha=0.3, zorder=0)
     ax.bar(x=0, height=20, width=2*np.pi, bottom=60, color=PHASE_COLORS["回復期"], alpha=0.3, zorder=0)
     ax.bar(x=0, height=40, width=2*np.pi, bottom=20, color=PHASE_COLORS["維持期"], alpha=0.3, zorder=0)
@@ -115,6 +127,1157 @@ def write_log(log_file, facility_id, patient_id, action):
     if not os.path.exists(log_file): log_df.to_csv(log_file, index=False, encoding='utf-8-sig')
     else: log_df.to_csv(log_file, mode='a', header=False, index=False, encoding='utf-8-sig')
 
+def get_file_version(filename):
+    """ファイルの更新時刻(ns)をデータのバージョンとして返す（ファイルが無ければ0）"""
+    return os.stat(filename).st_mtime_ns if os.path.exists(filename) else 0
+
+# --- 同時保存の楽観的排他制御 ---
+# 施設ごとに最新の患者データと版番号をプロセス内で共有する。各セッションは最後に同期した版（基準版）を持ち、
+# 項目ごとの保存では、基準版のときの値・最新の値・入力値を項目単位で比べて、ぶつからない項目だけを最新データにマージする。
+@st.cache_resource
+def get_hot_store():
+    return {"lock": threading.Lock(), "facilities": {}}
+
+def get_latest_entry(store, facility_id, filename):
+    """施設の最新データを返す（ロックを持った状態で呼ぶ）。ファイルが外部で書き換えられていれば読み直す"""
+    entry = store["facilities"].get(facility_id)
+    if entry is None or entry["file_version"] != get_file_version(filename):
+        df = load_data(filename); df['ステータス'] = df['ステータス'].fillna('在室中')
+        entry = {"df": df, "version": entry["version"] + 1 if entry else 1, "file_version": get_file_version(filename)}
+        store["facilities"][facility_id] = entry
+    return entry
+
+def publish_data(store, facility_id, df, filename):
+    """データを書き出して共有の最新データを差し替え、新しい版番号を返す（ロックを持った状態で呼ぶ）"""
+    df.to_csv(filename, index=False)
+    version = store["facilities"].get(facility_id, {"version": 0})["version"] + 1
+    store["facilities"][facility_id] = {"df": df.copy(), "version": version, "file_version": get_file_version(filename)}
+    return version
+
+def checkout_data(facility_id, filename):
+    """施設の最新データをセッションに読み込み、基準版を合わせる"""
+    store = get_hot_store()
+    with store["lock"]: entry = get_latest_entry(store, facility_id, filename); st.session_state.df = entry["df"].copy(); st.session_state.base_version = entry["version"]
+    st.session_state.data_version = st.session_state.base_version; st.session_state.asof_index = None
+
+def finish_save(df, patient_id):
+    st.session_state.data_version = st.session_state.base_version  # 表示用の結果は施設で共有する版番号をキーにする
+    if patient_id is not None: update_asof_index(patient_id)
+    else: st.session_state.asof_index = None
+    schedule_precompute(st.session_state.get('current_facility'), st.session_state.data_version, df, patient_id)
+
+def modify_data(filename, modify, patient_id=None):
+    """施設の最新データに modify（最新データのコピーを受け取り、保存するデータを返す）を適用して保存する。
+    読み出しから書き込みまでロックを持ったまま行うので、その間の他の端末の保存を上書きしない。
+    保存後の再表示で使うデータ・グラフはバックグラウンドで事前計算しておく。"""
+    facility_id = st.session_state.get('current_facility'); store = get_hot_store()
+    with store["lock"]:
+        df = modify(get_latest_entry(store, facility_id, filename)["df"].copy())
+        st.session_state.base_version = publish_data(store, facility_id, df, filename)
+    st.session_state.df = df; st.session_state.asof_index = None
+    finish_save(df, patient_id)
+
+def same_value(a, b):
+    if pd.isna(a) and pd.isna(b): return True
+    if pd.isna(a) or pd.isna(b): return False
+    try: return float(a) == float(b)
+    except (TypeError, ValueError): return str(a) == str(b)
+
+def split_events(value):
+    return {e.strip() for e in str(value).split(',') if e.strip()} if pd.notna(value) else set()
+
+def save_record_fields(filename, patient_id, record_date, time_of_day, updates, event_options=None, selected_events=None):
+    """1件の記録（患者・日付・時間帯）の指定した項目だけを、他の端末の更新を含む最新データにマージして保存する。
+    event_options を渡すと、イベントはその選択肢の範囲だけを selected_events に置き換える。
+    基準版以降に他の端末が同じ項目を別の値に変えていた場合、その項目は書き込まずに {項目: 最新の値} として返す。"""
+    facility_id = st.session_state.get('current_facility'); store = get_hot_store()
+    key_mask = lambda df: (df['アプリ用患者ID'] == patient_id) & (df['日付'] == str(record_date)) & (df['時間帯'] == time_of_day)
+    base_rows = st.session_state.df[key_mask(st.session_state.df)]; base_row = base_rows.iloc[-1] if not base_rows.empty else pd.Series(dtype=object)
+    updates = dict(updates); conflicts = {}
+    with store["lock"]:
+        entry = get_latest_entry(store, facility_id, filename); latest_df = entry["df"].copy()
+        foreign_changes = entry["version"] != st.session_state.get('base_version')  # 基準版のままなら他の端末の更新はない
+        latest_rows = latest_df[key_mask(latest_df)]; latest_row = latest_rows.iloc[-1] if not latest_rows.empty else pd.Series(dtype=object)
+        if foreign_changes:
+            for col, value in updates.items():
+                if not same_value(latest_row.get(col), base_row.get(col)) and not same_value(latest_row.get(col), value): conflicts[col] = latest_row.get(col)
+        if event_options is not None:
+            scope = set(event_options); selected = set(selected_events)
+            latest_scoped = split_events(latest_row.get('イベント')) & scope; base_scoped = split_events(base_row.get('イベント')) & scope
+            if foreign_changes and latest_scoped != base_scoped and latest_scoped != selected: conflicts['イベント'] = ", ".join(sorted(latest_scoped))
+            else: updates['イベント'] = ", ".join(sorted((split_events(latest_row.get('イベント')) - scope) | selected))
+        updates = {col: value for col, value in updates.items() if col not in conflicts}
+        if updates:
+            if latest_rows.empty:
+                latest_df = pd.concat([latest_df, pd.DataFrame([{"アプリ用患者ID": patient_id, "日付": str(record_date), "時間帯": time_of_day, **updates}])], ignore_index=True)
+                latest_df = latest_df.sort_values(by=RECORD_KEY_COLUMNS, kind='stable')
+            else:
+                latest_df = latest_df.drop(index=latest_rows.index[:-1])  # 重複していた記録は最後の1件にまとめる
+                for col, value in updates.items(): latest_df.loc[latest_rows.index[-1], col] = value
+            version = publish_data(store, facility_id, latest_df, filename)
+        else: version = entry["version"]
+    st.session_state.df = latest_df; st.session_state.base_version = version; st.session_state.data_version = version
+    if foreign_changes: st.session_state.asof_index = None
+    if updates: finish_save(latest_df, patient_id)
+    return conflicts
+
+def show_save_conflicts(conflicts, widget_keys):
+    """保存できなかった項目を再実行後のフォームに表示するために残し、入力欄は最新の値で表示し直す"""
+    if conflicts:
+        for key in widget_keys: st.session_state.pop(key, None)
+        details = "、".join(f"{col}（最新の値: {'なし' if pd.isna(value) or value == '' else int(value) if isinstance(value, float) and value.is_integer() else value}）" for col, value in conflicts.items())
+        st.session_state.save_conflict_message = f"他の端末で先に更新されたため、次の項目は保存されませんでした: {details}。最新の値を確認し、必要であれば再度記録してください。"
+
+def make_plot_datetime(dates, times):
+    """日付と時間帯から「プロット用日時」をベクトル演算で作る（朝は8時、それ以外は20時）"""
+    hours = np.where(pd.Series(times).eq('朝').to_numpy(), 8, 20)
+    return pd.to_datetime(pd.Series(dates), errors='coerce') + pd.to_timedelta(hours, unit='h').to_numpy()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def scan_data_anomalies(_df, data_version):
+    """スコアの急変と記録の整合性（勤務帯の欠落・キー重複・値域外）を全患者まとめて検出する。
+    結果は data_version ごとにキャッシュする（_df 自体はハッシュしない）。"""
+    group_keys = ['施設ID', 'アプリ用患者ID'] if '施設ID' in _df.columns else ['アプリ用患者ID']
+    result_columns = ['種別'] + group_keys + ['日付', '時間帯', '項目', '値', '詳細']
+    if _df.empty: return pd.DataFrame(columns=result_columns)
+    df = _df.reset_index(drop=True)
+    df['プロット用日時'] = make_plot_datetime(df['日付'], df['時間帯'])
+    raw_scores = df[SCORE_COLUMN_NAMES]
+    scores = raw_scores.apply(pd.to_numeric, errors='coerce')
+    findings = []
+
+    # 1. キー重複（同じ患者・日付・時間帯の記録が複数ある）
+    dup_counts = df.groupby(group_keys + ['日付', '時間帯']).size()
+    dup_counts = dup_counts[dup_counts > 1].reset_index(name='件数')
+    if not dup_counts.empty:
+        findings.append(dup_counts.assign(種別='キー重複', 項目='日付/時間帯', 値=dup_counts['件数'].astype(str), 詳細='同じ日付・時間帯の記録が' + dup_counts['件数'].astype(str) + '件あります'))
+
+    # 2. 値域外（スコアが0-100の数値でない、日付・時間帯が読めない）
+    out_of_range = (raw_scores.notna() & scores.isna()) | (scores < 0) | (scores > 100)
+    flagged = out_of_range.stack()
+    flagged = flagged[flagged]
+    if not flagged.empty:
+        rows, cols = flagged.index.get_level_values(0), flagged.index.get_level_values(1)
+        values = [raw_scores.at[r, c] for r, c in zip(rows, cols)]
+        findings.append(df.loc[rows, group_keys + ['日付', '時間帯']].assign(種別='値域外', 項目=list(cols), 値=[str(v) for v in values], 詳細='スコアは0〜100の数値で入力してください'))
+    bad_time = df['時間帯'].notna() & ~df['時間帯'].isin(['朝', '夕'])
+    bad_date = df['日付'].notna() & pd.to_datetime(df['日付'], errors='coerce').isna()
+    if bad_time.any():
+        findings.append(df.loc[bad_time, group_keys + ['日付', '時間帯']].assign(種別='値域外', 項目='時間帯', 値=df.loc[bad_time, '時間帯'].astype(str), 詳細='時間帯は「朝」または「夕」です'))
+    if bad_date.any():
+        findings.append(df.loc[bad_date, group_keys + ['日付', '時間帯']].assign(種別='値域外', 項目='日付', 値=df.loc[bad_date, '日付'].astype(str), 詳細='日付として読み取れません'))
+
+    # 3. 前回記録からの急変と、勤務帯の欠落（患者ごとに時系列で並べて一括で差分を取る）
+    ordered = df[df['プロット用日時'].notna()].copy()
+    ordered[SCORE_COLUMN_NAMES] = scores.where(~out_of_range)
+    ordered = ordered.sort_values(by=group_keys + ['プロット用日時'], kind='stable').drop_duplicates(subset=group_keys + ['プロット用日時'], keep='last')
+    grouped = ordered.groupby(group_keys, sort=False)
+    # 値域外・未入力の記録は飛ばし、項目ごとに直前の有効な値と比べる
+    previous = grouped[SCORE_COLUMN_NAMES].shift().groupby([ordered[k] for k in group_keys], sort=False).ffill()
+    jumps = ((ordered[SCORE_COLUMN_NAMES] - previous).abs() >= SCORE_JUMP_THRESHOLD).stack()
+    jumps = jumps[jumps]
+    if not jumps.empty:
+        rows, cols = jumps.index.get_level_values(0), jumps.index.get_level_values(1)
+        prev_values = [previous.at[r, c] for r, c in zip(rows, cols)]; curr_values = [ordered.at[r, c] for r, c in zip(rows, cols)]
+        findings.append(ordered.loc[rows, group_keys + ['日付', '時間帯']].assign(
+            種別='スコア急変', 項目=list(cols), 値=[f"{v:g}" for v in curr_values],
+            詳細=[f"前回 {p:g}点 → 今回 {c:g}点（{c - p:+g}点）" for p, c in zip(prev_values, curr_values)]))
+    shift_numbers = pd.Series(ordered['プロット用日時'].to_numpy().astype('datetime64[h]').astype('int64') // 12, index=ordered.index)
+    missing_shifts = shift_numbers.groupby([ordered[k] for k in group_keys], sort=False).diff() - 1
+    missing_shifts = missing_shifts[missing_shifts > 0]
+    if not missing_shifts.empty:
+        findings.append(ordered.loc[missing_shifts.index, group_keys + ['日付', '時間帯']].assign(
+            種別='勤務帯の欠落', 項目='日付/時間帯', 値=missing_shifts.astype(int).astype(str),
+            詳細='直前の記録との間に' + missing_shifts.astype(int).astype(str) + '勤務帯分の記録がありません'))
+
+    if not findings: return pd.DataFrame(columns=result_columns)
+    anomalies = pd.concat(findings, ignore_index=True)[result_columns]
+    return anomalies.sort_values(by=group_keys + ['日付', '時間帯'], kind='stable').reset_index(drop=True)
+
+def get_radar_series(df_sorted, current_idx, selected_time):
+    """レーダーチャートで比べる今回・前回の値と、その表示名・色・線種"""
+    current_record = df_sorted.iloc[current_idx]
+    previous_record = df_sorted.iloc[current_idx - 1] if current_idx > 0 else None
+    current_data = current_record[FACTOR_SCORE_NAMES].to_dict()
+    previous_data = previous_record[FACTOR_SCORE_NAMES].to_dict() if previous_record is not None else None
+    return (current_data, previous_data) + (("当日 夕", "当日 朝", 'red', 'blue', '-', '-') if selected_time == '夕' else ("当日 朝", "前日 夕", 'blue', 'red', '-', '--'))
+
+def create_patient_radar_chart(df_sorted, current_idx, selected_time):
+    """時系列に並べた患者データの current_idx 番目とその前回を比較するレーダーチャートを作る"""
+    current_data, previous_data, current_label, previous_label, current_color, previous_color, current_style, previous_style = get_radar_series(df_sorted, current_idx, selected_time)
+    return create_radar_chart(labels=FACTOR_SCORE_NAMES, current_data=current_data, previous_data=previous_data, current_label=current_label, previous_label=previous_label, current_color=current_color, previous_color=previous_color, current_style=current_style, previous_style=previous_style)
+
+EVENT_LABEL_ROW_HEIGHT = 10  # ラベル1段の高さ（スコアの点数）
+EVENT_LABEL_MAX_PER_RECORD = 3  # 1回の記録に並べるラベルの上限。超えた分は「+N」にまとめる
+EVENT_LABEL_MAX_ROWS_AWAY = 4  # 点からこの段数より離れた場所には置かない（どの点のラベルか分かるように）
+EVENT_LABEL_CHAR_INCHES = 0.17  # 全角1文字分のラベル幅（12インチ幅の軌跡シート上）
+EVENT_LABEL_AXES_INCHES = 10.5
+
+def explode_events(df_graph):
+    """記録ごとのイベント文字列を1イベント1行に展開する。印（各記録の最初のイベント）の行も返す"""
+    scored = df_graph.dropna(subset=['総合スコア']).assign(総合スコア=lambda d: pd.to_numeric(d['総合スコア'], errors='coerce'))[['プロット用日時', '総合スコア']].dropna()
+    events = scored.join(df_graph['イベント'].dropna().astype(str).str.split(',').explode().str.strip().rename('イベント'), how='inner')
+    markers = events.groupby(level=0).head(1); markers = markers[markers['イベント'].isin(EVENT_FLAGS.keys())]
+    return events[events['イベント'].isin(EVENT_FLAGS.keys())], markers
+
+def layout_event_labels(events):
+    """イベントのラベル位置を決める。時刻順に、点の上（空きがなければ下）で他のラベルと重ならない一番近い段に置く。
+    各段は最後に置いたラベルの右端だけを覚えておけばよいので、ラベル数に比例する時間で済む。
+    上限を超えた分と置き場所のない分は、その記録の位置に「+N」のラベルとしてまとめる（空きがなければ重なってもそこに置く）。"""
+    columns = ['プロット用日時', '表示位置', 'ラベル', '色']
+    if events.empty: return pd.DataFrame(columns=columns)
+    times = events['プロット用日時']; span_days = max((times.max() - times.min()) / pd.Timedelta(days=1), 1.0) + 1.0
+    def label_width(text):  # ラベルの幅（日数）
+        chars = sum(1.0 if ord(c) > 0x7f else 0.55 for c in text) + 1.0
+        return chars * EVENT_LABEL_CHAR_INCHES / EVENT_LABEL_AXES_INCHES * span_days
+    n_rows = int(110 // EVENT_LABEL_ROW_HEIGHT); right_edges = np.full(n_rows, -np.inf); placed = []
+    for (plot_time, score), group in events.groupby(['プロット用日時', '総合スコア'], sort=True):
+        x = (plot_time - times.min()) / pd.Timedelta(days=1)
+        point_row = min(max(int(score // EVENT_LABEL_ROW_HEIGHT), 0), n_rows - 1)  # 値域外のスコア（0未満・110以上）でも段の範囲に収める
+        candidate_rows = list(range(point_row + 1, min(n_rows, point_row + 1 + EVENT_LABEL_MAX_ROWS_AWAY))) + list(range(point_row - 1, max(-1, point_row - 1 - EVENT_LABEL_MAX_ROWS_AWAY), -1))
+        names = list(group['イベント']); shown = names[:EVENT_LABEL_MAX_PER_RECORD]; hidden = len(names) - len(shown)
+        for i, name in enumerate(shown):
+            half = label_width(name) / 2; row = next((r for r in candidate_rows if right_edges[r] <= x - half), None)
+            if row is None: hidden += len(shown) - i; break
+            right_edges[row] = x + half; candidate_rows.remove(row)
+            placed.append((plot_time, row * EVENT_LABEL_ROW_HEIGHT, name, EVENT_FLAGS[name]['color']))
+        if hidden:
+            text = f"+{hidden}"; half = label_width(text) / 2
+            row = next((r for r in candidate_rows if right_edges[r] <= x - half), min(point_row + 1, n_rows - 1))  # 別の時刻の記録にまとめると時刻がずれるので、重なってもこの位置に置く
+            right_edges[row] = max(right_edges[row], x + half); placed.append((plot_time, row * EVENT_LABEL_ROW_HEIGHT, text, 'gray'))
+    return pd.DataFrame(placed, columns=columns)
+
+def create_trajectory_chart(df_graph):
+    """軌跡シート（総合スコアの推移とイベント）のグラフを作る"""
+    # 総合スコアがNaNでない行だけをプロット対象とする
+    plot_df = df_graph.dropna(subset=['総合スコア']).copy()
+
+    fig = Figure(figsize=(12, 7)); ax = fig.subplots()
+
+    # 総合スコアが存在する点だけを結んだ線グラフを描画
+    if not plot_df.empty:
+        ax.plot(plot_df['プロット用日時'], pd.to_numeric(plot_df['総合スコア'], errors='coerce'), 
+                marker='o', linestyle='-', markersize=8, zorder=10)
+
+    # イベントのプロット（印は EVENT_FLAGS の形・色ごとに1回の scatter でまとめて描く）
+    events, markers = explode_events(df_graph)
+    for (marker, color), group in markers.groupby([markers['イベント'].map(lambda e: EVENT_FLAGS[e]['marker']), markers['イベント'].map(lambda e: EVENT_FLAGS[e]['color'])]):
+        ax.scatter(group['プロット用日時'], group['総合スコア'], color=color, marker=marker, s=200, zorder=12)
+    if prop:
+        for label in layout_event_labels(events).itertuples(index=False):
+            ax.text(label.プロット用日時, label.表示位置, f" {label.ラベル} ", ha='center', va='bottom',
+                    bbox=dict(boxstyle='round,pad=0.2', fc=label.色, alpha=0.7), fontproperties=prop, zorder=13)
+
+    # X軸の設定（全体の期間を正しく反映させる）
+    span_days = (df_graph['プロット用日時'].max() - df_graph['プロット用日時'].min()).days if not df_graph.empty else 0
+    ax.xaxis.set_major_locator(mdates.DayLocator(interval=max(1, span_days // 14 + 1)))  # 長期入室でも目盛りが重ならないように間引く
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
+    fig.autofmt_xdate(rotation=30)
+
+    # グラフのスタイル設定
+    ax.set_ylim(-5, 105); ax.grid(True, axis='y', linestyle='--', alpha=0.6)
+    if prop:
+        ax.set_title("治療フェーズの軌跡", fontsize=20, pad=20, fontproperties=prop)
+        ax.set_ylabel("総合スコア", fontsize=16, fontproperties=prop)
+        ax.set_xlabel("日付", fontsize=16, fontproperties=prop)
+        for label in ax.get_xticklabels() + ax.get_yticklabels():
+            label.set_fontproperties(prop)
+            label.set_fontsize(16)
+
+        bbox_style = dict(boxstyle='round,pad=0.4', fc='white', ec='none', alpha=0.85)
+        ax.axhspan(0, 20, color=PHASE_COLORS["超急性期"], alpha=0.3)
+        ax.axhspan(20, 60, color=PHASE_COLORS["維持期"], alpha=0.3)
+        ax.axhspan(60, 90, color=PHASE_COLORS["回復期"], alpha=0.3)
+        ax.axhspan(80, 100, color=PHASE_COLORS["転棟期"], alpha=0.3)
+        ax.text(0.02, 0.1, "超急性期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
+        ax.text(0.02, 0.4, "維持期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
+        ax.text(0.02, 0.7, "回復期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
+        ax.text(0.02, 0.9, "転棟期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
+    else:
+        ax.set_title("Trajectory Sheet", fontsize=20, pad=20)
+        ax.set_ylabel("Score", fontsize=16)
+        ax.set_xlabel("Date", fontsize=16)
+        ax.tick_params(axis='both', which='major', labelsize=16)
+
+    fig.tight_layout(pad=2.0)
+    return fig
+
+def build_phase_band_image():
+    """フェーズ帯（PHASE_COLORS）の背景を0〜100点の縦1列のRGBA画像として作る"""
+    phase_per_score = pd.cut(np.arange(100) + 0.5, bins=[0, 20, 60, 90, 100], labels=PHASE_LABELS)
+    return np.array([to_rgba(PHASE_COLORS[phase], alpha=0.3) for phase in phase_per_score]).reshape(100, 1, 4)
+
+PHASE_BAND_IMAGE = build_phase_band_image()
+WARD_OVERVIEW_COLUMNS = 4
+PHASE_LABELS_EN = {"超急性期": "Hyperacute", "維持期": "Maintenance", "回復期": "Recovery", "転棟期": "Transfer"}  # 日本語フォントが無いときの表記
+
+def create_ward_overview_chart(active_df):
+    """在室中の全患者の軌跡を1枚の図に小さく並べる（病棟一覧）。
+    施設データは1回だけ派生列を計算してグループ化し、フェーズ帯は共通の背景画像を各パネルに貼る。"""
+    ward_df = calculate_derived_columns(active_df)
+    ward_df['総合スコア'] = pd.to_numeric(ward_df['総合スコア'], errors='coerce')
+    patient_groups = list(ward_df.groupby('アプリ用患者ID', sort=True))
+    n_cols = min(WARD_OVERVIEW_COLUMNS, len(patient_groups)); n_rows = -(-len(patient_groups) // n_cols)
+    fig = Figure(figsize=(4.5 * n_cols, 3.2 * n_rows))
+    axes = fig.subplots(n_rows, n_cols, sharey=True, squeeze=False).ravel()
+    text_kwargs = dict(fontproperties=prop) if prop else {}
+    for ax, (patient_id, patient_df) in zip(axes, patient_groups):
+        ax.imshow(PHASE_BAND_IMAGE, extent=(0, 1, 0, 100), transform=ax.get_yaxis_transform(), aspect='auto', origin='lower', zorder=0)
+        scored = patient_df.dropna(subset=['総合スコア'])
+        ax.plot(scored['プロット用日時'], scored['総合スコア'], marker='o', markersize=3, linestyle='-', color='#1f497d', zorder=5)
+        if not scored.empty:
+            latest = scored.iloc[-1]
+            ax.scatter(latest['プロット用日時'], latest['総合スコア'], s=60, color='#1f497d', zorder=6)
+            status = f"{int(latest['総合スコア'])}点 {latest['フェーズ']}" if prop else f"{int(latest['総合スコア'])} pts {PHASE_LABELS_EN.get(latest['フェーズ'], '')}"
+        else: status = "-"
+        disease_group = patient_df['疾患群'].dropna().iloc[-1] if patient_df['疾患群'].notna().any() else "-"
+        ax.set_title(f"{patient_id}（{disease_group}） {status}" if prop else f"{patient_id} {status}", fontsize=11, **text_kwargs)
+        # 背景画像の範囲がX軸の自動調整に入らないよう、表示範囲は記録の期間から決める
+        ax.set_xlim(patient_df['プロット用日時'].min() - pd.Timedelta(hours=12), patient_df['プロット用日時'].max() + pd.Timedelta(hours=12))
+        ax.set_ylim(0, 100); ax.grid(True, axis='y', linestyle='--', alpha=0.4)
+        span_days = (patient_df['プロット用日時'].max() - patient_df['プロット用日時'].min()).days
+        ax.xaxis.set_major_locator(mdates.DayLocator(interval=max(1, span_days // 4 + 1))); ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
+        ax.tick_params(axis='both', labelsize=9)
+    for ax in axes[len(patient_groups):]: ax.set_visible(False)
+    handles = [Patch(facecolor=PHASE_COLORS[phase], alpha=0.6, label=phase if prop else PHASE_LABELS_EN[phase]) for phase in PHASE_LABELS]
+    fig.legend(handles=handles, loc='upper center', ncol=len(handles), frameon=False, bbox_to_anchor=(0.5, 1.0), **({"prop": prop} if prop else {}))
+    fig.tight_layout(rect=(0, 0, 1, 1 - 0.35 / (3.2 * n_rows)))
+    return fig
+
+def figure_to_png(fig):
+    """Figure を st.pyplot と同じ設定でPNGに変換する"""
+    buffer = io.BytesIO(); fig.savefig(buffer, format='png', bbox_inches='tight', dpi=200)
+    return buffer.getvalue()
+
+# --- ブラウザ描画モード（Vega-Lite） ---
+# Matplotlib でPNGを作る代わりに、データと描画仕様（JSON）だけを送ってブラウザで描く。
+# フェーズ帯・EVENT_FLAGS の色と形・日本語の表記はPNG版とそろえる。
+def polygon_path(n_points, inner_radius=None, rotation=0.0):
+    """正多角形（inner_radius を渡すと星形）のSVGパス（-1〜1の範囲）"""
+    radii = [1.0, inner_radius] * n_points if inner_radius else [1.0] * n_points
+    angles = rotation + np.arange(len(radii)) * 2 * np.pi / len(radii)
+    return "M" + "L".join(f"{r * np.sin(a):.3f},{-r * np.cos(a):.3f}" for r, a in zip(radii, angles)) + "Z"
+
+VEGA_SHAPES = {"o": "circle", "s": "square", "v": "triangle-down", "^": "triangle-up", "D": "diamond", "P": "cross",
+               "X": "M-0.7,-1L0,-0.3L0.7,-1L1,-0.7L0.3,0L1,0.7L0.7,1L0,0.3L-0.7,1L-1,0.7L-0.3,0L-1,-0.7Z",
+               "+": "M-1,-0.12L1,-0.12L1,0.12L-1,0.12ZM-0.12,-1L0.12,-1L0.12,1L-0.12,1Z",
+               "*": polygon_path(5, inner_radius=0.4), "h": polygon_path(6)}
+PHASE_BANDS = [{"フェーズ": phase, "下限": lower, "上限": upper, "中央": (lower + upper) / 2} for phase, lower, upper in zip(PHASE_LABELS, [0, 20, 60, 90], [20, 60, 90, 100])]
+PHASE_SCALE = {"domain": PHASE_LABELS, "range": [PHASE_COLORS[phase] for phase in PHASE_LABELS]}
+VEGA_DASHES = {'-': [1, 0], '--': [6, 4]}
+
+def use_client_charts():
+    return st.session_state.get("client_charts", False)
+
+def to_vega_values(df):
+    """DataFrame を Vega-Lite の data.values（日時はISO文字列、欠損は null）にする"""
+    return json.loads(df.to_json(orient='records', date_format='iso', force_ascii=False))
+
+def vega_phase_band_layers(with_labels=True, legend=None):
+    layers = [{"data": {"values": PHASE_BANDS}, "mark": {"type": "rect", "opacity": 0.3},
+               "encoding": {"y": {"field": "下限", "type": "quantitative"}, "y2": {"field": "上限"}, "fill": {"field": "フェーズ", "type": "nominal", "scale": PHASE_SCALE, "legend": legend}}}]
+    if with_labels:
+        layers.append({"data": {"values": PHASE_BANDS}, "mark": {"type": "text", "align": "left", "fontSize": 16, "color": "#333"},
+                       "encoding": {"x": {"value": 8}, "y": {"field": "中央", "type": "quantitative"}, "text": {"field": "フェーズ", "type": "nominal"}}})
+    return layers
+
+def event_scales(event_names):
+    names = [e for e in EVENT_FLAGS if e in set(event_names)]
+    return ({"domain": names, "range": [EVENT_FLAGS[e]['color'] for e in names]}, {"domain": names, "range": [VEGA_SHAPES.get(EVENT_FLAGS[e]['marker'], "circle") for e in names]})
+
+def build_trajectory_spec(df_graph):
+    """軌跡シートの Vega-Lite 仕様"""
+    plot_df = df_graph.dropna(subset=['総合スコア']).assign(総合スコア=lambda d: pd.to_numeric(d['総合スコア'], errors='coerce'))[['プロット用日時', '総合スコア']]
+    events, markers = explode_events(df_graph); labels = layout_event_labels(events)
+    color_scale, shape_scale = event_scales(markers['イベント'])
+    x = {"field": "プロット用日時", "type": "temporal", "title": "日付", "axis": {"format": "%m/%d", "labelAngle": -30, "tickCount": "day"}}
+    layers = vega_phase_band_layers() + [
+        {"data": {"values": to_vega_values(plot_df)}, "mark": {"type": "line", "point": {"size": 80}},
+         "encoding": {"x": x, "y": {"field": "総合スコア", "type": "quantitative", "title": "総合スコア", "scale": {"domain": [-5, 105], "nice": False}}}}]
+    if not events.empty:
+        layers += [{"data": {"values": to_vega_values(markers)}, "mark": {"type": "point", "filled": True, "size": 250, "opacity": 1},
+                    "encoding": {"x": x, "y": {"field": "総合スコア", "type": "quantitative"}, "color": {"field": "イベント", "type": "nominal", "scale": color_scale, "title": "イベント"},
+                                 "shape": {"field": "イベント", "type": "nominal", "scale": shape_scale, "title": "イベント"}}},
+                   {"data": {"values": to_vega_values(labels)}, "mark": {"type": "text", "baseline": "bottom", "fontSize": 13, "fontWeight": "bold"},
+                    "encoding": {"x": x, "y": {"field": "表示位置", "type": "quantitative"}, "text": {"field": "ラベル", "type": "nominal"}, "color": {"field": "色", "type": "nominal", "scale": None}}}]
+    return {"title": {"text": "治療フェーズの軌跡", "fontSize": 20}, "height": 450, "layer": layers}
+
+def build_ward_overview_spec(active_df):
+    """病棟一覧の Vega-Lite 仕様。患者ごとの小さな軌跡を WARD_OVERVIEW_COLUMNS 列に並べる"""
+    ward_df = calculate_derived_columns(active_df)
+    ward_df['総合スコア'] = pd.to_numeric(ward_df['総合スコア'], errors='coerce')
+    panels = []
+    for patient_id, patient_df in ward_df.groupby('アプリ用患者ID', sort=True):
+        scored = patient_df.dropna(subset=['総合スコア'])
+        status = f"{int(scored.iloc[-1]['総合スコア'])}点 {scored.iloc[-1]['フェーズ']}" if not scored.empty else "-"
+        disease_group = patient_df['疾患群'].dropna().iloc[-1] if patient_df['疾患群'].notna().any() else "-"
+        x = {"field": "プロット用日時", "type": "temporal", "title": None, "axis": {"format": "%m/%d", "tickCount": 4}}
+        y = {"field": "総合スコア", "type": "quantitative", "title": None, "scale": {"domain": [0, 100], "nice": False}}
+        values = to_vega_values(scored[['プロット用日時', '総合スコア']])
+        panels.append({"title": {"text": f"{patient_id}（{disease_group}） {status}", "fontSize": 13}, "width": 220, "height": 140,
+                       "layer": vega_phase_band_layers(with_labels=False, legend={"orient": "top", "title": None}) + [
+                           {"data": {"values": values}, "mark": {"type": "line", "point": {"size": 20}, "color": "#1f497d"}, "encoding": {"x": x, "y": y}},
+                           {"data": {"values": values[-1:]}, "mark": {"type": "point", "filled": True, "size": 80, "opacity": 1, "color": "#1f497d"}, "encoding": {"x": x, "y": y}}]})
+    return {"concat": panels, "columns": WARD_OVERVIEW_COLUMNS}
+
+def build_radar_spec(df_sorted, current_idx, selected_time):
+    """コンディションサマリー（レーダーチャート）の Vega-Lite 仕様。極座標は事前に x, y に変換して送る"""
+    current_data, previous_data, current_label, previous_label, current_color, previous_color, current_style, previous_style = get_radar_series(df_sorted, current_idx, selected_time)
+    angles = np.pi / 2 - np.linspace(0, 2 * np.pi, len(FACTOR_SCORE_NAMES), endpoint=False)
+    series = [(current_label, current_data)] + ([(previous_label, previous_data)] if previous_data is not None else [])
+    points = [{"系列": label, "項目": name, "スコア": float(pd.to_numeric(data.get(name), errors='coerce')), "順序": i, "x": None, "y": None}
+              for label, data in series for i, name in enumerate(FACTOR_SCORE_NAMES + FACTOR_SCORE_NAMES[:1])]
+    for point in points:
+        score = 0.0 if np.isnan(point["スコア"]) else point["スコア"]; angle = angles[point["順序"] % len(FACTOR_SCORE_NAMES)]
+        point.update(x=score * np.cos(angle), y=score * np.sin(angle), スコア=None if np.isnan(point["スコア"]) else point["スコア"])
+    axis_labels = [{"項目": name, "x": 118 * np.cos(a), "y": 118 * np.sin(a)} for name, a in zip(FACTOR_SCORE_NAMES, angles)]
+    grid = [{"項目": name, "x": 100 * np.cos(a), "y": 100 * np.sin(a)} for name, a in zip(FACTOR_SCORE_NAMES, angles)]
+    labels = [current_label, previous_label][:len(series)]
+    hidden = {"axis": None, "scale": {"domain": [-130, 130]}}
+    layers = [{"data": {"values": PHASE_BANDS}, "mark": {"type": "arc", "opacity": 0.3},
+               "encoding": {"theta": {"value": 2 * np.pi}, "radius": {"field": "上限", "type": "quantitative", "scale": {"type": "linear", "domain": [0, 130], "range": [0, 200], "zero": True}}, "radius2": {"field": "下限"},
+                            "fill": {"field": "フェーズ", "type": "nominal", "scale": PHASE_SCALE, "legend": None}}},
+              {"data": {"values": grid}, "mark": {"type": "rule", "color": "#bbb"}, "encoding": {"x": {"datum": 0, **hidden}, "y": {"datum": 0, **hidden}, "x2": {"field": "x"}, "y2": {"field": "y"}}},
+              {"data": {"values": points}, "mark": {"type": "line", "point": True, "strokeWidth": 2},
+               "encoding": {"x": {"field": "x", "type": "quantitative", **hidden}, "y": {"field": "y", "type": "quantitative", **hidden}, "order": {"field": "順序", "type": "quantitative"},
+                            "color": {"field": "系列", "type": "nominal", "title": None, "scale": {"domain": labels, "range": [current_color, previous_color][:len(series)]}},
+                            "strokeDash": {"field": "系列", "type": "nominal", "legend": None, "scale": {"domain": labels, "range": [VEGA_DASHES[current_style], VEGA_DASHES[previous_style]][:len(series)]}},
+                            "tooltip": [{"field": "系列", "type": "nominal"}, {"field": "項目", "type": "nominal"}, {"field": "スコア", "type": "quantitative"}]}},
+              {"data": {"values": axis_labels}, "mark": {"type": "text", "fontSize": 13}, "encoding": {"x": {"field": "x", "type": "quantitative", **hidden}, "y": {"field": "y", "type": "quantitative", **hidden}, "text": {"field": "項目", "type": "nominal"}}}]
+    return {"width": 400, "height": 400, "layer": layers, "view": {"stroke": None}}
+
+def build_overlay_spec(group_df, mean_trajectory, disease_group, patient_id=None, patient_df=None):
+    """軌跡の比較（重ね合わせ）の Vega-Lite 仕様"""
+    x = {"field": "プロット用経過日数", "type": "quantitative", "title": "ICU入室後経過日数"}
+    y = {"field": "総合スコア", "type": "quantitative", "title": "総合スコア", "scale": {"domain": [0, 105]}}
+    lines = group_df[['アプリ用患者ID', 'プロット用経過日数', 'プロット用日時', '総合スコア']].assign(総合スコア=lambda d: pd.to_numeric(d['総合スコア'], errors='coerce'))
+    highlighted = mean_trajectory.assign(系列=f'{disease_group} 平均')
+    domain, colors = [f'{disease_group} 平均'], ['red']
+    if patient_id is not None:
+        highlighted = pd.concat([highlighted, patient_df[['プロット用経過日数', '総合スコア']].assign(総合スコア=lambda d: pd.to_numeric(d['総合スコア'], errors='coerce'), 系列=f'治療中: {patient_id}')], ignore_index=True)
+        domain.append(f'治療中: {patient_id}'); colors.append('springgreen')
+    layers = [{"data": {"values": to_vega_values(lines)}, "mark": {"type": "line", "point": True, "opacity": 0.3},
+               "encoding": {"x": x, "y": y, "detail": {"field": "アプリ用患者ID", "type": "nominal"}, "color": {"field": "アプリ用患者ID", "type": "nominal", "legend": None}, "order": {"field": "プロット用日時", "type": "temporal"}}},
+              {"data": {"values": to_vega_values(highlighted)}, "mark": {"type": "line", "point": True, "strokeWidth": 3},
+               "encoding": {"x": x, "y": y, "color": {"field": "系列", "type": "nominal", "title": None, "scale": {"domain": domain, "range": colors}}}}]
+    return {"title": {"text": f"【{disease_group}】治療軌跡の重ね合わせ", "fontSize": 16}, "height": 400, "layer": layers, "resolve": {"scale": {"color": "independent"}}}
+
+def build_recovery_speed_spec(average_speed, disease_group):
+    """回復速度（日次スコア変化の平均）の Vega-Lite 仕様"""
+    speed_df = average_speed.rename('平均スコア変化量').rename_axis('経過日数').reset_index()
+    return {"title": {"text": f"【{disease_group}】回復速度", "fontSize": 16}, "height": 300, "data": {"values": to_vega_values(speed_df)},
+            "layer": [{"mark": "bar", "encoding": {"x": {"field": "経過日数", "type": "ordinal", "title": "ICU入室後経過日数"},
+                                                   "y": {"field": "平均スコア変化量", "type": "quantitative", "title": "前日からの平均スコア変化量"},
+                                                   "color": {"condition": {"test": "datum['平均スコア変化量'] >= 0", "value": "skyblue"}, "value": "salmon"}}},
+                      {"mark": {"type": "rule", "color": "grey"}, "encoding": {"y": {"datum": 0}}}]}
+
+def build_phase_days_spec(days_in_phase):
+    """フェーズ別滞在日数の箱ひげ図の Vega-Lite 仕様"""
+    return {"title": {"text": "疾患群ごとのフェーズ別滞在日数", "fontSize": 16}, "height": 400, "data": {"values": to_vega_values(days_in_phase.astype({'フェーズ': str}))},
+            "mark": {"type": "boxplot", "extent": 1.5},
+            "encoding": {"x": {"field": "疾患群", "type": "nominal", "title": "疾患群", "axis": {"labelAngle": -30}}, "xOffset": {"field": "フェーズ", "type": "nominal", "sort": PHASE_LABELS},
+                         "y": {"field": "日数", "type": "quantitative", "title": "滞在日数"}, "color": {"field": "フェーズ", "type": "nominal", "scale": PHASE_SCALE, "title": "フェーズ"}}}
+
+def build_similar_patients_spec(index, similar, patient_id, patient_df):
+    """類似した過去の患者の経過の Vega-Lite 仕様"""
+    positions = {pid: i for i, pid in enumerate(index["patient_ids"])}
+    past = pd.concat([pd.DataFrame({"プロット用経過日数": np.arange(SIMILARITY_MAX_SLOTS) / 2 + 1, "総合スコア": index["vectors"][positions[pid], :, 0], "系列": f'{pid}（{outcome}）' if outcome else pid})
+                      for pid, outcome in zip(similar["患者ID"], similar["退室時転帰"])], ignore_index=True)
+    current = patient_df[['プロット用経過日数', '総合スコア']].assign(総合スコア=lambda d: pd.to_numeric(d['総合スコア'], errors='coerce'), 系列=f'治療中: {patient_id}')
+    x = {"field": "プロット用経過日数", "type": "quantitative", "title": "ICU入室後経過日数"}
+    y = {"field": "総合スコア", "type": "quantitative", "title": "総合スコア", "scale": {"domain": [0, 105]}}
+    return {"title": {"text": "類似した過去の患者の経過", "fontSize": 16}, "height": 350,
+            "layer": [{"data": {"values": to_vega_values(past.dropna())}, "mark": {"type": "line", "strokeDash": [6, 4], "opacity": 0.7},
+                       "encoding": {"x": x, "y": y, "color": {"field": "系列", "type": "nominal", "title": None}}},
+                      {"data": {"values": to_vega_values(current)}, "mark": {"type": "line", "point": True, "strokeWidth": 3, "color": "springgreen"},
+                       "encoding": {"x": x, "y": y}}]}
+
+def build_archived_frame(archived_rows):
+    """統計ダッシュボード用に、退室済患者の派生列（フェーズ・経過日数など）を計算する"""
+    archived_df = calculate_derived_columns(archived_rows.copy())
+    archived_df['プロット用経過日数'] = archived_df['経過日数'] + np.where(archived_df['時間帯'] == '夕', 0.5, 0.0) if not archived_df.empty else None
+    return archived_df
+
+def compute_group_aggregates(group_df):
+    """疾患群の平均軌跡と、日次スコア変化量の平均（回復速度）を計算する"""
+    ordered = group_df.sort_values(by=['アプリ用患者ID', 'プロット用日時']).assign(総合スコア=lambda d: pd.to_numeric(d['総合スコア'], errors='coerce'))
+    mean_trajectory = ordered.groupby('プロット用経過日数')['総合スコア'].mean().reset_index()
+    ordered['スコア変化量'] = ordered.groupby('アプリ用患者ID')['総合スコア'].diff()
+    average_speed = ordered.groupby('経過日数')['スコア変化量'].mean()
+    return mean_trajectory, average_speed
+
+# --- 類似した過去の患者（軌跡の近傍検索） ---
+# 退室済患者の総合スコアと7要因スコアを「入室後の勤務帯（朝・夕）」ごとの固定長ベクトルに並べた索引を作っておき、
+# 治療中の患者のここまでの経過と、同じ期間どうしの二乗平均誤差（RMSE）で全員を一括比較する。
+SIMILARITY_MAX_SLOTS = 56  # 入室後28日分（朝・夕）
+SIMILARITY_MIN_OVERLAP = 0.5  # 比較できた勤務帯がこの割合に満たない患者は候補から外す
+SIMILAR_PATIENT_COUNT = 5
+SIMILARITY_INDEX_COLUMNS = ["アプリ用患者ID", "日付", "時間帯", "疾患群", "退室時転帰"] + SCORE_COLUMN_NAMES
+
+def build_score_slots(df):
+    """記録を (患者数, 勤務帯数, スコア数) の配列に並べる。記録のない勤務帯は前後の記録から線形補間する"""
+    if df.empty: return np.array([], dtype=object), np.empty((0, SIMILARITY_MAX_SLOTS, len(SCORE_COLUMN_NAMES)))
+    dates = pd.to_datetime(df['日付'], errors='coerce')
+    slots = (dates - dates.groupby(df['アプリ用患者ID']).transform('min')).dt.days * 2 + (df['時間帯'] == '夕').astype(int)
+    valid = slots.notna() & (slots < SIMILARITY_MAX_SLOTS)
+    scores = df.loc[valid, SCORE_COLUMN_NAMES].apply(pd.to_numeric, errors='coerce').assign(患者=df.loc[valid, 'アプリ用患者ID'], 勤務帯=slots[valid].astype(int))
+    grid = scores.groupby(['患者', '勤務帯'])[SCORE_COLUMN_NAMES].mean().unstack('勤務帯')
+    grid = grid.reindex(columns=pd.MultiIndex.from_product([SCORE_COLUMN_NAMES, range(SIMILARITY_MAX_SLOTS)]))
+    flat = pd.DataFrame(grid.to_numpy(dtype=float).reshape(-1, SIMILARITY_MAX_SLOTS)).interpolate(axis=1, limit_area='inside')
+    vectors = flat.to_numpy().reshape(len(grid), len(SCORE_COLUMN_NAMES), SIMILARITY_MAX_SLOTS).transpose(0, 2, 1)
+    return grid.index.to_numpy(dtype=object), vectors
+
+def build_similarity_index(archived_rows):
+    """退室済患者の軌跡ベクトルと、候補の絞り込み・表示に使う患者情報をまとめる"""
+    patient_ids, vectors = build_score_slots(archived_rows)
+    info = archived_rows.groupby('アプリ用患者ID')[['疾患群', '退室時転帰']].last().reindex(patient_ids)
+    # 在室日数はベクトル（先頭 SIMILARITY_MAX_SLOTS 勤務帯で打ち切り）ではなく、記録の全期間から求める（経過日数と同じく入室日を1日目とする）
+    dates = pd.to_datetime(archived_rows['日付'], errors='coerce').groupby(archived_rows['アプリ用患者ID'])
+    stay_days = ((dates.max() - dates.min()).dt.days + 1).reindex(patient_ids).to_numpy(dtype=float)
+    return {"patient_ids": patient_ids, "vectors": vectors, "stay_days": stay_days,
+            "disease_groups": info['疾患群'].to_numpy(dtype=object), "outcomes": info['退室時転帰'].to_numpy(dtype=object)}
+
+def find_similar_patients(index, patient_rows, disease_group=None, k=SIMILAR_PATIENT_COUNT):
+    """治療中の患者のここまでの経過に近い退室済患者を k 人返す（距離の小さい順）"""
+    columns = ["患者ID", "距離（RMSE）", "比較した勤務帯数", "在室日数", "疾患群", "退室時転帰"]
+    _, query = build_score_slots(patient_rows)
+    if len(query) == 0 or len(index["patient_ids"]) == 0: return pd.DataFrame(columns=columns)
+    query = query[0]; observed = ~np.isnan(query).all(axis=1)
+    if not observed.any(): return pd.DataFrame(columns=columns)
+    length = len(observed) - np.argmax(observed[::-1])
+    diff = index["vectors"][:, :length] - query[:length]; compared = ~np.isnan(diff)
+    counts = compared.sum(axis=(1, 2)); compared_slots = compared.any(axis=2).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmse = np.sqrt(np.where(compared, diff ** 2, 0).sum(axis=(1, 2)) / counts)
+    candidates = (compared_slots >= SIMILARITY_MIN_OVERLAP * observed[:length].sum()) & (counts > 0)
+    if disease_group is not None: candidates &= index["disease_groups"] == disease_group
+    order = np.argsort(np.where(candidates, rmse, np.inf), kind='stable')[:k]; order = order[candidates[order]]
+    return pd.DataFrame({"患者ID": index["patient_ids"][order], "距離（RMSE）": rmse[order].round(1), "比較した勤務帯数": compared_slots[order],
+                         "在室日数": index["stay_days"][order], "疾患群": index["disease_groups"][order], "退室時転帰": index["outcomes"][order]}, columns=columns)
+
+def create_similar_patients_chart(index, similar, patient_id, patient_df):
+    """治療中の患者の総合スコアに、類似した退室済患者のその後を含む全経過を重ねる"""
+    fig = Figure(figsize=(10, 5)); ax = fig.subplots()
+    days = np.arange(SIMILARITY_MAX_SLOTS) / 2 + 1; positions = {pid: i for i, pid in enumerate(index["patient_ids"])}
+    for pid, outcome in zip(similar["患者ID"], similar["退室時転帰"]):
+        ax.plot(days, index["vectors"][positions[pid], :, 0], linestyle='--', alpha=0.6, label=f'{pid}（{outcome}）' if outcome else pid)
+    patient_df = patient_df.sort_values(by='プロット用日時')
+    ax.plot(patient_df['プロット用経過日数'], pd.to_numeric(patient_df['総合スコア'], errors='coerce'), marker='o', linewidth=3, color='springgreen', label=f'治療中: {patient_id}', zorder=15)
+    if prop:
+        ax.set_title("類似した過去の患者の経過", fontsize=16, fontproperties=prop); ax.set_xlabel("ICU入室後経過日数", fontsize=16, fontproperties=prop)
+        ax.set_ylabel("総合スコア", fontsize=16, fontproperties=prop); ax.legend(prop=prop)
+        for label in ax.get_xticklabels() + ax.get_yticklabels(): label.set_fontproperties(prop)
+    else:
+        ax.set_title("Similar Past Patients"); ax.set_xlabel("Days since ICU admission"); ax.set_ylabel("Total Score"); ax.legend()
+    ax.set_ylim(0, 105); ax.grid(True, linestyle='--', alpha=0.6)
+    return fig
+
+# --- バックグラウンド事前計算 ---
+# 保存直後に、再実行（st.rerun）で必要になる派生データやグラフ画像をワーカースレッドで先に作っておく。
+# 結果は (種類, 施設ID, データバージョン, ...) をキーにプロセス全体で共有する。データバージョンは施設で共有する版番号（基準版）なので、
+# 後からログインしたセッションも同じ結果を使える。新しい版が出たジョブは途中で打ち切る。
+PRECOMPUTE_MAX_RESULTS = 128
+PRECOMPUTE_STATUS_INTERVAL = "2s"  # 準備状況の表示を更新する間隔
+
+@st.cache_resource
+def get_precompute_state():
+    return {"pool": ThreadPoolExecutor(max_workers=2, thread_name_prefix="precompute"), "lock": threading.Lock(),
+            "results": OrderedDict(), "pending": {}, "jobs": {}, "latest_version": {}}
+
+def store_precomputed(key, value):
+    state = get_precompute_state()
+    with state["lock"]:
+        state["results"][key] = value; state["results"].move_to_end(key)
+        while len(state["results"]) > PRECOMPUTE_MAX_RESULTS: state["results"].popitem(last=False)
+
+def compute_once(key, compute):
+    """結果があればそれを返す。他のスレッドがそのキーを計算中ならその1件だけを待ち、無ければ自分で計算して共有する"""
+    state = get_precompute_state()
+    with state["lock"]:
+        if key in state["results"]: state["results"].move_to_end(key); return state["results"][key]
+        pending = state["pending"].get(key); owner = pending is None
+        if owner: pending = state["pending"][key] = threading.Event()
+    if not owner:
+        pending.wait(timeout=30)
+        with state["lock"]:
+            if key in state["results"]: return state["results"][key]
+    try:
+        value = compute(); store_precomputed(key, value); return value
+    finally:
+        if owner:
+            with state["lock"]: state["pending"].pop(key, None)
+            pending.set()
+
+def get_or_compute(key, compute):
+    """事前計算済みならそれを、無ければその場で計算して結果を共有する"""
+    value = compute_once(key, compute)
+    return value.copy() if isinstance(value, pd.DataFrame) else value
+
+def run_precompute_job(facility_id, data_version, patient_id, patient_df, render_images=True):
+    """各結果はキーごとに compute_once で作るので、表示側が先に計算した結果は作り直さず、表示側は計算中の1件だけを待つ"""
+    def is_stale():
+        return get_precompute_state()["latest_version"].get(facility_id, 0) > data_version
+    if patient_id is not None and not patient_df.empty:
+        display_df = compute_once(("derived", facility_id, data_version, patient_id), lambda: calculate_derived_columns(patient_df))
+        if is_stale(): return
+        if render_images:  # ブラウザ描画モードではPNGは作らない
+            compute_once(("trajectory", facility_id, data_version, patient_id), lambda: figure_to_png(create_trajectory_chart(display_df)))
+            df_sorted = display_df.sort_values(by='プロット用日時').reset_index(drop=True)
+            latest = df_sorted.iloc[-1]
+            compute_once(("radar", facility_id, data_version, patient_id, str(latest['日付'].date()), latest['時間帯']), lambda: figure_to_png(create_patient_radar_chart(df_sorted, len(df_sorted) - 1, latest['時間帯'])))
+    if is_stale(): return
+    cold_version = get_cold_version(facility_id)  # 退室済患者の集計はコールド領域が変わったときだけ作り直す
+    archived_df = compute_once(("archived", facility_id, cold_version), lambda: build_archived_frame(read_cold_partitions(facility_id, ARCHIVE_DASHBOARD_COLUMNS)))
+    if is_stale(): return
+    compute_once(("similarity", facility_id, cold_version), lambda: build_similarity_index(read_cold_partitions(facility_id, SIMILARITY_INDEX_COLUMNS)))
+    groups = patient_df['疾患群'].dropna().unique() if patient_id is not None else archived_df['疾患群'].dropna().unique()
+    for group in groups:
+        if is_stale(): return
+        compute_once(("group", facility_id, cold_version, group), lambda: compute_group_aggregates(archived_df[archived_df['疾患群'] == group]))
+
+def schedule_precompute(facility_id, data_version, df, patient_id=None):
+    """保存後の表示データの事前計算をワーカーに投入する。同じ施設の古いジョブは取り消す"""
+    state = get_precompute_state()
+    patient_df = df[df['アプリ用患者ID'] == patient_id].copy() if patient_id is not None else df.iloc[0:0].copy()
+    with state["lock"]:
+        state["latest_version"][facility_id] = max(data_version, state["latest_version"].get(facility_id, 0))
+        previous_job = state["jobs"].get(facility_id)
+        if previous_job and previous_job[0] < data_version: previous_job[1].cancel()
+        future = state["pool"].submit(run_precompute_job, facility_id, data_version, patient_id, patient_df, not st.session_state.get("client_charts", False))
+        state["jobs"][facility_id] = (data_version, future)
+
+def get_precompute_status(facility_id):
+    """施設の事前計算ジョブがまだ終わっていなければ True"""
+    state = get_precompute_state()
+    with state["lock"]: job = state["jobs"].get(facility_id)
+    return job is not None and not job[1].done()
+
+# --- ホット/コールド階層化 ---
+# 施設の作業ファイル（CSV）には在室中の患者だけを置き、退室済の患者は
+# cold_data/facility_id=<施設ID>/month=<YYYY-MM>/part.parquet に月別・列指向で移す（施設×月で1ファイル）。
+# ダッシュボードやマスター画面は必要な列・条件だけを読み込む（列・述語のプッシュダウン）。
+COLD_DATA_DIR = "cold_data"
+COLD_PARTITIONING = ds.partitioning(pa.schema([("facility_id", pa.string()), ("month", pa.string())]), flavor="hive")
+ARCHIVE_DASHBOARD_COLUMNS = ["アプリ用患者ID", "日付", "時間帯", "総合スコア", "イベント", "疾患群"]
+COLD_VERSION_FILE_NAME = "_version"  # "_" で始まるファイルは Parquet の読み込み対象にならない
+COLD_PART_FILE_NAME = "part.parquet"
+
+def get_cold_dir(facility_id):
+    return os.path.join(COLD_DATA_DIR, f"facility_id={facility_id}")
+
+def get_cold_month_dir(facility_id, month):
+    return os.path.join(get_cold_dir(facility_id), f"month={month}")
+
+def bump_cold_version(facility_id):
+    """施設のコールド領域を書き換えたら呼ぶ。版ファイルを置き換えて、キャッシュ用のバージョンを進める"""
+    path = os.path.join(get_cold_dir(facility_id), COLD_VERSION_FILE_NAME); os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f: f.write(str(time.time_ns()))
+    os.replace(tmp_path, path)
+
+def get_cold_version(facility_id=None):
+    """コールド領域のキャッシュ用バージョン（施設ごとの版ファイルの値）。ディレクトリは走査しない"""
+    def read_version(fid):
+        try:
+            with open(os.path.join(get_cold_dir(fid), COLD_VERSION_FILE_NAME)) as f: return int(f.read() or 0)
+        except (OSError, ValueError): return 0
+    if facility_id is not None: return read_version(facility_id)
+    return tuple((fid, read_version(fid)) for fid in list_cold_facilities())
+
+COLD_FILE_SCHEMA = pa.schema([(col, pa.float64() if col in SCORE_COLUMN_NAMES else pa.string()) for col in ALL_COLUMN_NAMES])
+
+def to_cold_schema(df):
+    """パーティション間で型がずれないよう、スコアは float、それ以外は文字列にそろえる"""
+    cold_df = df.reindex(columns=ALL_COLUMN_NAMES).copy()
+    cold_df[SCORE_COLUMN_NAMES] = cold_df[SCORE_COLUMN_NAMES].apply(pd.to_numeric, errors='coerce').astype('float64')
+    for col in ALL_COLUMN_NAMES:
+        if col not in SCORE_COLUMN_NAMES: cold_df[col] = cold_df[col].astype(object).map(lambda v: None if pd.isna(v) else str(v))
+    return cold_df
+
+def get_cold_months(cold_df):
+    return pd.to_datetime(cold_df['日付'], errors='coerce').dt.strftime('%Y-%m').fillna('unknown')
+
+def read_cold_month(facility_id, month):
+    files = sorted(glob.glob(os.path.join(glob.escape(get_cold_month_dir(facility_id, month)), "*.parquet")))
+    if not files: return to_cold_schema(pd.DataFrame(columns=ALL_COLUMN_NAMES))
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+
+def write_cold_month(facility_id, month, rows):
+    """月のパーティションを1ファイルに書き直す（旧形式の患者別ファイルもここで1つにまとめる）。空なら月ごと消す"""
+    month_dir = get_cold_month_dir(facility_id, month); os.makedirs(month_dir, exist_ok=True)
+    path = os.path.join(month_dir, COLD_PART_FILE_NAME)
+    old_files = [f for f in glob.glob(os.path.join(glob.escape(month_dir), "*.parquet")) if f != path]
+    if rows.empty: old_files.append(path)
+    else:
+        tmp_path = os.path.join(month_dir, f"_{COLD_PART_FILE_NAME}.{threading.get_ident()}.tmp")
+        to_cold_schema(rows).to_parquet(tmp_path, index=False, schema=COLD_FILE_SCHEMA); os.replace(tmp_path, path)
+    for f in old_files:
+        if os.path.exists(f): os.remove(f)
+    try: os.rmdir(month_dir)  # 空になった月のディレクトリは消す
+    except OSError: pass
+
+def archive_patients_to_cold(facility_id, archived_df):
+    """退室済の患者の記録を、施設×月のParquetファイルに足し込む。
+    同じ患者IDの過去の入室分は残し、同じ記録（患者ID・日付・時間帯）だけ新しい方で置き換える。"""
+    cold_df = to_cold_schema(archived_df)
+    existing = read_cold_partitions(facility_id, filters=[("アプリ用患者ID", "in", list(cold_df['アプリ用患者ID'].dropna().unique()))]).drop(columns=['month'])
+    if not existing.empty: update_facility_summary(facility_id, existing, sign=-1)
+    update_facility_summary(facility_id, pd.concat([existing, cold_df], ignore_index=True).drop_duplicates(subset=RECORD_KEY_COLUMNS, keep='last'))
+    for month, rows in cold_df.groupby(get_cold_months(cold_df), sort=False):
+        merged = pd.concat([read_cold_month(facility_id, month), rows], ignore_index=True).drop_duplicates(subset=RECORD_KEY_COLUMNS, keep='last')
+        write_cold_month(facility_id, month, merged)
+    bump_cold_version(facility_id)
+
+def read_cold_patient(facility_id, patient_id):
+    return read_cold_partitions(facility_id, filters=[("アプリ用患者ID", "==", str(patient_id))]).drop(columns=['month'])
+
+def delete_cold_patient(facility_id, patient_id):
+    rows = read_cold_partitions(facility_id, filters=[("アプリ用患者ID", "==", str(patient_id))])
+    if rows.empty: return
+    update_facility_summary(facility_id, rows.drop(columns=['month']), sign=-1)
+    for month in rows['month'].unique():
+        month_rows = read_cold_month(facility_id, month)
+        write_cold_month(facility_id, month, month_rows[month_rows['アプリ用患者ID'] != str(patient_id)])
+    bump_cold_version(facility_id)
+
+def read_cold_partitions(facility_id=None, columns=None, filters=None):
+    """コールド領域を読む。facility_id を指定するとその施設のディレクトリだけ、
+    columns / filters（pyarrow の述語）は読み込み時に適用される。"""
+    root = get_cold_dir(facility_id) if facility_id is not None else COLD_DATA_DIR
+    partition_columns = ["month"] if facility_id is not None else ["facility_id", "month"]
+    if not glob.glob(os.path.join(glob.escape(root), "**", "*.parquet"), recursive=True):
+        return pd.DataFrame(columns=list(columns) if columns else ALL_COLUMN_NAMES + partition_columns)
+    partitioning = ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive") if facility_id is not None else COLD_PARTITIONING
+    df = pd.read_parquet(root, columns=list(columns) if columns else None, filters=filters, partitioning=partitioning)
+    for col in partition_columns:
+        if col in df.columns: df[col] = df[col].astype(str)
+    return df
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def read_cold_partitions_cached(facility_id, columns, filters, cold_version):
+    return read_cold_partitions(facility_id, columns, filters)
+
+def load_archived_data(facility_id=None, columns=None, filters=None):
+    """退室済患者のデータを読む（コールド領域のバージョンごとにキャッシュ）"""
+    return read_cold_partitions_cached(facility_id, tuple(columns) if columns else None, tuple(filters) if filters else None, get_cold_version(facility_id))
+
+def list_cold_months(facility_id=None):
+    pattern = os.path.join(glob.escape(get_cold_dir(facility_id)) if facility_id is not None else os.path.join(COLD_DATA_DIR, "facility_id=*"), "month=*")
+    return sorted({os.path.basename(d).replace("month=", "") for d in glob.glob(pattern)})
+
+def list_cold_facilities():
+    return sorted(os.path.basename(d).replace("facility_id=", "") for d in glob.glob(os.path.join(COLD_DATA_DIR, "facility_id=*")))
+
+# --- 疾患群ごとの集計サマリー（施設間でマージ可能） ---
+# 退室時に、ICU滞在日数・各マイルストーンまでの日数を「日数→人数」のヒストグラムとして、
+# 患者数・合併症の経験者数をカウンタとして施設ごとに足し込んでおく（在室中に戻したら引く）。
+# 日数は整数なので、各施設のヒストグラムを足し合わせるだけで全施設の中央値・四分位範囲が正確に求まる。
+MILESTONE_EVENTS = ["抜管", "SBT成功", "昇圧薬離脱", "補助循環離脱", "腎代替療法終了"]
+COMPLICATION_EVENTS = ["再挿管", "気管切開", "新規不整脈", "出血イベント", "せん妄", "新規感染症"]
+SUMMARY_FILE_NAME = "_summary.json"  # "_" で始まるファイルは Parquet の読み込み対象にならない
+
+@st.cache_resource
+def get_summary_lock():
+    return threading.Lock()
+
+def to_histogram(values):
+    return {str(int(day)): int(count) for day, count in values.dropna().value_counts().items()}
+
+def summarize_archived_patients(rows):
+    """患者の記録から、疾患群ごとのヒストグラムとカウンタを作る"""
+    derived = calculate_derived_columns(rows.copy())
+    if derived.empty: return {}
+    patient_to_group = derived.drop_duplicates(subset='アプリ用患者ID').set_index('アプリ用患者ID')['疾患群'].dropna()
+    los = derived.groupby('アプリ用患者ID')['経過日数'].max()
+    events = derived[['アプリ用患者ID', '経過日数']].assign(イベント=derived['イベント'].fillna('').astype(str).str.split(r'\s*,\s*', regex=True)).explode('イベント')
+    first_event_day = events.groupby(['イベント', 'アプリ用患者ID'])['経過日数'].min()
+    summary = {}
+    for group, patient_ids in patient_to_group.groupby(patient_to_group).groups.items():
+        group_events = first_event_day[first_event_day.index.get_level_values('アプリ用患者ID').isin(patient_ids)]
+        histograms = {"ICU滞在日数": to_histogram(los.reindex(patient_ids))}
+        for event in MILESTONE_EVENTS:
+            histograms[event] = to_histogram(group_events.loc[event]) if event in group_events.index.get_level_values('イベント') else {}
+        counts = {"患者数": len(patient_ids)}
+        for event in COMPLICATION_EVENTS:
+            counts[event] = int(len(group_events.loc[event])) if event in group_events.index.get_level_values('イベント') else 0
+        summary[group] = {"histograms": histograms, "counts": counts}
+    return summary
+
+def merge_summaries(left, right, sign=1):
+    """2つのサマリーを足し合わせる（sign=-1 で引く）。0件になった項目は消す"""
+    merged = {}
+    for key in set(left) | set(right):
+        a, b = left.get(key), right.get(key)
+        value = merge_summaries(a or {}, b or {}, sign) if isinstance(a, dict) or isinstance(b, dict) else (a or 0) + sign * (b or 0)
+        if value: merged[key] = value
+    return merged
+
+def histogram_quantile(histogram, q):
+    """ヒストグラムから分位点を求める（pandas の quantile と同じ線形補間）"""
+    if not histogram: return np.nan
+    values = np.array(sorted(float(v) for v in histogram)); counts = np.array([histogram[str(int(v))] for v in values])
+    cumulative = np.cumsum(counts); position = q * (cumulative[-1] - 1)
+    lower = values[np.searchsorted(cumulative, np.floor(position), side='right')]; upper = values[np.searchsorted(cumulative, np.ceil(position), side='right')]
+    return lower + (upper - lower) * (position - np.floor(position))
+
+def get_summary_file(facility_id):
+    return os.path.join(get_cold_dir(facility_id), SUMMARY_FILE_NAME)
+
+def save_facility_summary(facility_id, summary):
+    path = get_summary_file(facility_id); os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f: json.dump(summary, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+def load_facility_summary(facility_id):
+    path = get_summary_file(facility_id)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f: return json.load(f)
+    # サマリー導入前にアーカイブされた分は、コールド領域から作り直す
+    summary = summarize_archived_patients(read_cold_partitions(facility_id).drop(columns=['month']))
+    if summary: save_facility_summary(facility_id, summary)
+    return summary
+
+def update_facility_summary(facility_id, rows, sign=1):
+    with get_summary_lock():
+        save_facility_summary(facility_id, merge_summaries(load_facility_summary(facility_id), summarize_archived_patients(rows), sign))
+
+def build_summary_table(summary):
+    """サマリーから重要指標の表（中央値 [IQR]・経験率）を作る"""
+    index_names = ["患者数 (人)", "ICU総滞在日数 (中央値 [IQR])"] + [f"{e}までの日数 (中央値 [IQR])" for e in MILESTONE_EVENTS] + [f"{e} 経験率 (%)" for e in COMPLICATION_EVENTS]
+    summary_df = pd.DataFrame(index=index_names, columns=sorted(summary))
+    for group, entry in summary.items():
+        histograms, counts = entry.get("histograms", {}), entry.get("counts", {}); total = counts.get("患者数", 0)
+        summary_df.loc["患者数 (人)", group] = f"{total}"
+        for event, row_name in [("ICU滞在日数", "ICU総滞在日数 (中央値 [IQR])")] + [(e, f"{e}までの日数 (中央値 [IQR])") for e in MILESTONE_EVENTS]:
+            histogram = histograms.get(event, {})
+            if histogram: summary_df.loc[row_name, group] = f"{histogram_quantile(histogram, 0.5):.1f} [{histogram_quantile(histogram, 0.25):.1f} - {histogram_quantile(histogram, 0.75):.1f}]"
+        for event in COMPLICATION_EVENTS:
+            if total > 0: summary_df.loc[f"{event} 経験率 (%)", group] = f"{counts.get(event, 0) / total * 100:.1f} ({counts.get(event, 0)}/{total})"
+    return summary_df.fillna("-")
+
+# --- 入力フォームの初期値（as-of 検索） ---
+# 患者ごとに記録を「プロット用日時」順に並べた配列を持ち、任意の(日付, 時間帯)に対する
+# その時点の記録・直前の記録・最新の疾患群を二分探索（O(log n)）で引けるようにする。
+ASOF_COLUMNS = SCORE_COLUMN_NAMES + ["イベント", "疾患群"]
+
+def build_asof_entry(patient_df):
+    plot_times = make_plot_datetime(patient_df['日付'], patient_df['時間帯'])
+    ordered = patient_df.assign(プロット用日時=plot_times.to_numpy())
+    ordered = ordered[ordered['プロット用日時'].notna()].sort_values(by='プロット用日時', kind='stable')
+    disease_groups = ordered['疾患群'].ffill()
+    return {"times": ordered['プロット用日時'].to_numpy(dtype='datetime64[ns]').astype('int64'),
+            "columns": {col: ordered[col].to_numpy(dtype=object) for col in ASOF_COLUMNS},
+            "disease_groups": disease_groups.to_numpy(dtype=object),
+            "first_disease_group": disease_groups.bfill().iloc[0] if not ordered.empty else None}
+
+def build_asof_index(df):
+    """全患者分の as-of 検索用の配列を、施設データを1回グループ化して作る"""
+    return {patient_id: build_asof_entry(patient_df) for patient_id, patient_df in df.groupby('アプリ用患者ID', sort=False)}
+
+def update_asof_index(patient_id):
+    """保存した患者の分だけ as-of 検索用の配列を作り直す"""
+    if st.session_state.get('asof_index') is None: return
+    patient_df = st.session_state.df[st.session_state.df['アプリ用患者ID'] == patient_id]
+    if patient_df.empty: st.session_state.asof_index.pop(patient_id, None)
+    else: st.session_state.asof_index[patient_id] = build_asof_entry(patient_df)
+
+def lookup_asof(patient_id, record_date, time_of_day):
+    """(日付, 時間帯)時点の記録・それより前の直近の記録・その時点の疾患群を返す"""
+    if st.session_state.get('asof_index') is None: st.session_state.asof_index = build_asof_index(st.session_state.df)
+    entry = st.session_state.asof_index.get(patient_id)
+    if entry is None or len(entry["times"]) == 0: return None, None, None
+    target = make_plot_datetime([str(record_date)], [time_of_day]).to_numpy(dtype='datetime64[ns]').astype('int64')[0]
+    left = int(np.searchsorted(entry["times"], target, side='left')); right = int(np.searchsorted(entry["times"], target, side='right'))
+    def record_at(i): return {col: values[i] for col, values in entry["columns"].items()}
+    existing_record = record_at(right - 1) if right > left else None
+    previous_record = record_at(left - 1) if left > 0 else None
+    disease_group = entry["disease_groups"][right - 1] if right > 0 else None
+    if disease_group is None or pd.isna(disease_group): disease_group = entry["first_disease_group"]
+    return existing_record, previous_record, disease_group
+
+# --- 画面の部品（フラグメント） ---
+# 各部品は @st.fragment で独立して再実行される。引数がその部品の依存データで、
+# 部品内のウィジェット操作ではその部品だけが再実行される（保存時は st.rerun() でアプリ全体を更新する）。
+@st.fragment(run_every=PRECOMPUTE_STATUS_INTERVAL)
+def render_precompute_status(facility_id):
+    """事前計算の準備状況（依存データ: 施設の事前計算ジョブ）。ジョブの完了に合わせて表示が変わるよう、この部品だけ定期的に再実行する"""
+    st.caption("⏳ 表示データを準備中" if get_precompute_status(facility_id) else "✅ 表示データは最新です")
+
+def get_patient_view(facility_id, patient_id, data_version):
+    return get_or_compute(("derived", facility_id, data_version, patient_id), lambda: calculate_derived_columns(st.session_state.df[st.session_state.df['アプリ用患者ID'] == patient_id].copy()))
+
+def get_archived_view(facility_id, cold_version):
+    return get_or_compute(("archived", facility_id, cold_version), lambda: build_archived_frame(load_archived_data(facility_id, ARCHIVE_DASHBOARD_COLUMNS)))
+
+def get_similarity_index(facility_id, cold_version):
+    return get_or_compute(("similarity", facility_id, cold_version), lambda: build_similarity_index(load_archived_data(facility_id, SIMILARITY_INDEX_COLUMNS)))
+
+@st.fragment
+def render_input_form(facility_id, patient_id_to_use, DATA_FILE):
+    """多職種スコア入力フォーム（依存データ: 施設の患者データ、選択中の患者）"""
+    st.subheader("データ入力・修正"); st.write(f"**対象患者:** {patient_id_to_use}")
+    if st.session_state.get("save_conflict_message"): st.warning(st.session_state.pop("save_conflict_message"))
+    record_date = st.date_input("日付", datetime.date.today())
+
+    if not st.session_state.get("trial_mode"):
+        if record_date > datetime.date.today(): st.error("未来の日付は入力できません。"); st.stop()
+
+    time_of_day = st.selectbox("時間帯", options=["朝", "夕"])
+    default_values = {name: 10 for name in FACTOR_SCORE_NAMES}; default_values["総合スコア"] = 10; default_values["イベント"] = ""
+    existing_record, previous_record, latest_disease_group = lookup_asof(patient_id_to_use, record_date, time_of_day)
+    default_values["疾患群"] = latest_disease_group if latest_disease_group is not None and pd.notna(latest_disease_group) else DISEASE_OPTIONS[0]
+    if existing_record is not None:
+        for col, val in existing_record.items():
+            if pd.notna(val) and col in default_values: default_values[col] = val
+    elif previous_record is not None:
+        for col, val in previous_record.items():
+            if pd.notna(val) and col in default_values and col != 'イベント': default_values[col] = val
+    disease_group_index = DISEASE_OPTIONS.index(default_values["疾患群"]) if default_values["疾患群"] in DISEASE_OPTIONS else 3
+    disease_group_select = st.selectbox("疾患群を選択", options=DISEASE_OPTIONS, index=disease_group_index)
+    disease_group = st.text_input("疾患群を自由記載", value=default_values["疾患群"]) if disease_group_select == "その他（自由記載）" else disease_group_select
+    st.write("---"); st.write("**多職種スコア入力**")
+    guidelines = {
+        "循環スコア": "- **0-19:** 昇圧薬(高用量) or 補助循環(ECMO/Impella)導入 or 致死的不整脈\n- **20-39:** 昇圧薬(中等量) or 補助循環化に安定\n- **40-59:** 昇圧薬(少量) or 補助循環weaning\n- **60-89:** 昇圧薬離脱 or 補助循環終了\n- **90-100:** 循環動態が安定",
+        "呼吸スコア": "- **0-19:** 高い呼吸器設定、筋弛緩使用\n- **20-39:** 自発呼吸モード、低い呼吸器設定、非挿管だが頻呼吸\n- **40-59:** SBT成功～抜管\n- **60-89:** 抜管～HFNC/NPPV離脱\n- **90-100:** 経鼻酸素～酸素なしで安定",
+        "意識_鎮静スコア": "- **0-19:** 深い鎮静(RASS-4~-5) or 意識障害\n- **20-39:** 浅い鎮静(RASS-1~-3) or せん妄\n- **40-59:** SAT成功\n- **60-89:** 会話可能 or 良好な筆談\n- **90-100:** 意識清明、良好な睡眠",
+        "腎_体液スコア": "- **0-19:** 大量輸液・輸血が必要\n- **20-39:** 大量輸液は不要だが除水はできず\n- **40-59:** バランス±0～-500mL/dayほどの緩徐なマイナスバランス\n- **60-89:** refilling、積極的な除水\n- **90-100:** 適正体重への除水達成",
+        "活動_リハスコア": "- **0-19:** 体位変換にも制限、ROM訓練のみ\n- **20-39:** ベッド上安静（ギャッジアップなど）\n- **40-59:** 端座位達成\n- **60-89:** 立位達成\n- **90-100:** 室内歩行開始",
+        "栄養_消化管スコア": "- **0-19:** 絶食、消化管トラブルあり\n- **20-39:** 経腸栄養(少量)開始\n- **40-59:** 経腸栄養を増量中\n- **60-89:** 目標カロリー達成、経口摂取開始\n- **90-100:** 経口摂取が自立",
+        "感染_炎症スコア": "- **0-19:** 敗血症性ショック\n- **20-39:** マーカー高値だがIL-6、PCT peak out\n- **40-59:** 解熱、CRPもpeak out\n- **60-89:** 抗菌薬のDe-escalation済み、CRP<10mg/dL\n- **90-100:** 抗菌薬終了、炎症反応正常化"
+    }
+    factor_scores = {}; selected_events_map = {}
+    score_event_map = {"循環スコア": "#循環", "呼吸スコア": "#呼吸", "意識_鎮静スコア": "#意識/鎮静", "腎_体液スコア": "#腎/体液", "活動_リハスコア": "#活動/リハ", "栄養_消化管スコア": "#栄養/消化管", "感染_炎症スコア": "#感染/炎症"}
+    default_event_list = [e.strip() for e in default_values.get("イベント", "").split(',')] if default_values.get("イベント", "") else []
+    for score_name, category in score_event_map.items():
+        col1, col2 = st.columns([0.85, 0.15])
+        with col1: factor_scores[score_name] = create_score_input(score_name, default_values.get(score_name, 10), score_name)
+        with col2: st.popover("❓", help="スコアリングの目安").markdown(guidelines[score_name])
+        category_events = [event for event, props in EVENT_FLAGS.items() if props.get("category") == category]
+        default_category_events = [e for e in default_event_list if e in category_events]
+        selected_events_map[score_name] = st.multiselect(f"{score_name} 関連イベント", options=category_events, default=default_category_events, key=f"{score_name}_events")
+        if st.button(f"【{score_name}】と関連イベントのみ記録", key=f"save_{score_name}"):
+            conflicts = save_record_fields(DATA_FILE, patient_id_to_use, record_date, time_of_day, {score_name: factor_scores[score_name]}, category_events, selected_events_map[score_name])
+            show_save_conflicts(conflicts, [f"{score_name}_slider", f"{score_name}_number", f"{score_name}_events"])
+            if not conflicts: st.success(f"{score_name}と関連イベントを記録しました！")
+            st.rerun()
+        st.write("---")
+    st.write("**ICU医師 最終判断**"); total_score = create_score_input("総合スコア", default_values.get("総合スコア", 10), "total_score")
+    if st.button("【総合スコア】のみ記録", key="save_total_score"):
+        conflicts = save_record_fields(DATA_FILE, patient_id_to_use, record_date, time_of_day, {"総合スコア": total_score})
+        show_save_conflicts(conflicts, ["total_score_slider", "total_score_number"])
+        if not conflicts: st.success("総合スコアを記録しました！")
+        st.rerun()
+    general_events_options = [event for event, props in EVENT_FLAGS.items() if props.get("category") == "#その他"]
+    default_general_events = [e for e in default_event_list if e in general_events_options]
+    selected_general_events = st.multiselect("その他イベント", options=general_events_options, default=default_general_events, key="general_events")
+    if st.button("【総合スコアと全項目】を一括で記録・修正する", type="primary"):
+        all_selected_events = selected_general_events
+        for score_name in score_event_map: all_selected_events.extend(selected_events_map[score_name])
+        event_text = ", ".join(sorted(list(set(all_selected_events))))
+        previous_total_score = pd.to_numeric(previous_record["総合スコア"], errors='coerce') if previous_record is not None else None
+        if previous_total_score is not None and pd.notna(previous_total_score):
+            if abs(total_score - previous_total_score) >= SCORE_JUMP_THRESHOLD: st.warning(f"注意：スコアが前回({int(previous_total_score)}点)から{SCORE_JUMP_THRESHOLD}点以上変動しています。内容を確認してください。")
+        new_data_dict = {"総合スコア": total_score, "イベント": event_text, "ステータス": "在室中", "疾患群": disease_group}; new_data_dict.update(factor_scores)
+        conflicts = save_record_fields(DATA_FILE, patient_id_to_use, record_date, time_of_day, new_data_dict)
+        LOG_FILE = f"{LOG_FILE_PREFIX}{facility_id}.csv"; write_log(LOG_FILE, facility_id, patient_id_to_use, "データ一括記録/修正")
+        show_save_conflicts(conflicts, ["total_score_slider", "total_score_number", "general_events"] + [f"{name}_{suffix}" for name in score_event_map for suffix in ("slider", "number", "events")])
+        if not conflicts: st.success("全項目を記録しました！")
+        st.rerun()
+
+@st.fragment
+def render_patient_summary(facility_id, patient_id_to_use, data_version):
+    """スコアサマリーとレーダーチャート（依存データ: 選択中の患者の記録 @ data_version）"""
+    display_df = get_patient_view(facility_id, patient_id_to_use, data_version)
+    if display_df.empty: return
+    st.header(f"患者: {patient_id_to_use}")
+    latest_record_main = display_df.sort_values(by="日付", ascending=False).iloc[0]
+    st.markdown(f"#### **疾患群:** {latest_record_main['疾患群']}")
+    st.write("---")
+
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        available_dates = sorted(pd.to_datetime(display_df['日付']).dt.date.unique(), reverse=True)
+        selected_date = st.selectbox("日付を選択", options=available_dates, format_func=lambda d: d.strftime('%Y-%m-%d'))
+    with col2:
+        times_on_date = display_df[pd.to_datetime(display_df['日付']).dt.date == selected_date]['時間帯'].unique()
+        index_val = 1 if "夕" in times_on_date and len(times_on_date) > 1 else 0
+        selected_time = st.radio("時間帯を選択", ["朝", "夕"], horizontal=True, index=index_val)
+
+    df_sorted = display_df.sort_values(by='プロット用日時').reset_index(drop=True)
+    current_index = df_sorted.index[(df_sorted['日付'].dt.date == selected_date) & (df_sorted['時間帯'] == selected_time)].tolist()
+
+    if current_index:
+        current_idx = current_index[0]
+        current_record = df_sorted.iloc[current_idx]
+        previous_record = df_sorted.iloc[current_idx - 1] if current_idx > 0 else None
+
+        st.subheader("スコアサマリー")
+        cols_metric = st.columns(2)
+        with cols_metric[0]:
+            if previous_record is not None:
+                phase_color = PHASE_COLORS.get(previous_record['フェーズ'], '#888')
+                score_display = int(previous_record["総合スコア"]) if pd.notna(previous_record["総合スコア"]) else "-"
+                st.markdown(f'<div class="metric-container"> <div style="font-size: 14px; color: #888;">前回 ({previous_record["日付"].strftime("%m/%d")} {previous_record["時間帯"]})</div> <div style="font-size: 32px; font-weight: bold; color: #333;">{score_display}</div> <div style="font-size: 18px; font-weight: bold; color: {phase_color};">{previous_record["フェーズ"]}</div> </div>', unsafe_allow_html=True)
+            else:
+                st.info("比較対象の前回データがありません。")
+        with cols_metric[1]:
+            phase_color = PHASE_COLORS.get(current_record['フェーズ'], '#888')
+            score_display = int(current_record["総合スコア"]) if pd.notna(current_record["総合スコア"]) else "-"
+            st.markdown(f'<div class="metric-container"> <div style="font-size: 14px; color: #888;">今回 ({current_record["日付"].strftime("%m/%d")} {current_record["時間帯"]})</div> <div style="font-size: 32px; font-weight: bold; color: #1f497d;">{score_display}</div> <div style="font-size: 18px; font-weight: bold; color: {phase_color};">{current_record["フェーズ"]}</div> </div>', unsafe_allow_html=True)
+
+        st.write("---")
+        st.subheader("コンディションサマリー（比較）")
+        if use_client_charts(): st.vega_lite_chart(build_radar_spec(df_sorted, current_idx, selected_time))
+        else:
+            fig_radar_png = get_or_compute(("radar", facility_id, data_version, patient_id_to_use, str(selected_date), selected_time), lambda: figure_to_png(create_patient_radar_chart(df_sorted, current_idx, selected_time)))
+            st.image(fig_radar_png, width="stretch")
+    else:
+        st.info(f"{selected_date.strftime('%Y-%m-%d')} {selected_time} のデータはありません。")
+
+    st.write("---")
+
+@st.fragment
+def render_trajectory(facility_id, patient_id_to_use, data_version):
+    """軌跡シート（依存データ: 選択中の患者の記録 @ data_version）"""
+    display_df = get_patient_view(facility_id, patient_id_to_use, data_version)
+    st.subheader("軌跡シート")
+    df_graph = display_df.copy()
+    if not df_graph.empty:
+        st.write("---")
+        if use_client_charts(): st.vega_lite_chart(build_trajectory_spec(df_graph), width="stretch")
+        else:
+            trajectory_png = get_or_compute(("trajectory", facility_id, data_version, patient_id_to_use), lambda: figure_to_png(create_trajectory_chart(df_graph)))
+            st.image(trajectory_png, width="stretch")
+    else:
+        st.info(f"「{patient_id_to_use}」さんのデータはまだありません。")
+
+@st.fragment
+def render_ward_overview(facility_id, data_version):
+    """病棟一覧（依存データ: 施設の在室中患者 @ data_version）"""
+    active_df = st.session_state.df[st.session_state.df['ステータス'] == '在室中']
+    if active_df.empty: st.info("在室中の患者はいません。"); return
+    st.header(f"病棟一覧（在室中 {active_df['アプリ用患者ID'].nunique()}名）")
+    if use_client_charts(): st.vega_lite_chart(build_ward_overview_spec(active_df))
+    else: st.image(get_or_compute(("ward", facility_id, data_version), lambda: figure_to_png(create_ward_overview_chart(active_df))), width="stretch")
+
+@st.fragment
+def render_trajectory_comparison_tab(facility_id, data_version, cold_version):
+    """統計ダッシュボード「軌跡の比較」タブ（依存データ: 施設の在室中患者 @ data_version、退室済患者 @ cold_version）"""
+    archived_df_dashboard = get_archived_view(facility_id, cold_version)
+    st.subheader("治療軌跡の重ね合わせプロット")
+    st.info("このグラフは、選択された疾患群の全患者の回復曲線（半透明の線）と、その平均軌跡（赤線）を示しています。これにより、その疾患の典型的な回復パターンと、個々の患者のばらつきを視覚的に把握できます。")
+    disease_groups = archived_df_dashboard['疾患群'].dropna().unique()
+    if len(disease_groups) > 0:
+        selected_disease_group = st.selectbox("分析したい疾患群を選択してください", options=disease_groups)
+        if selected_disease_group:
+            active_df = st.session_state.df[st.session_state.df['ステータス'] == '在室中'].copy(); active_df = calculate_derived_columns(active_df)
+            active_df['プロット用経過日数'] = active_df.apply(lambda row: row['経過日数'] + 0.5 if row['時間帯'] == '夕' else row['経過日数'], axis=1)
+            active_patients_in_group = active_df[active_df['疾患群'] == selected_disease_group]['アプリ用患者ID'].unique()
+            selected_active_patient = st.selectbox("比較したい治療中の患者を選択（任意）", options=["比較しない"] + list(active_patients_in_group))
+            group_df = archived_df_dashboard[archived_df_dashboard['疾患群'] == selected_disease_group]; patient_ids = group_df['アプリ用患者ID'].unique()
+            mean_trajectory, average_speed = get_or_compute(("group", facility_id, cold_version, selected_disease_group), lambda: compute_group_aggregates(group_df))
+            current_patient_df = active_df[active_df['アプリ用患者ID'] == selected_active_patient].sort_values(by='プロット用日時') if selected_active_patient != "比較しない" else None
+            if use_client_charts(): st.vega_lite_chart(build_overlay_spec(group_df, mean_trajectory, selected_disease_group, selected_active_patient if current_patient_df is not None else None, current_patient_df), width="stretch")
+            else:
+                fig = Figure(figsize=(10, 6)); ax = fig.add_subplot()
+                for patient_id in patient_ids:
+                    patient_df = group_df[group_df['アプリ用患者ID'] == patient_id]; patient_df = patient_df.sort_values(by='プロット用日時')
+                    ax.plot(patient_df['プロット用経過日数'], pd.to_numeric(patient_df['総合スコア'], errors='coerce'), marker='o', linestyle='-', alpha=0.3, label='_nolegend_')
+                if not group_df.empty:
+                    ax.plot(mean_trajectory['プロット用経過日数'], mean_trajectory['総合スコア'], marker='o', linestyle='-', linewidth=3, color='red', label=f'{selected_disease_group} 平均')
+                if selected_active_patient != "比較しない":
+                    ax.plot(current_patient_df['プロット用経過日数'], pd.to_numeric(current_patient_df['総合スコア'], errors='coerce'), marker='o', linestyle='-', linewidth=3, color='springgreen', label=f'治療中: {selected_active_patient}', zorder=15)
+                if prop:
+                    ax.set_title(f"【{selected_disease_group}】治療軌跡の重ね合わせ", fontsize=16, fontproperties=prop); ax.set_xlabel("ICU入室後経過日数", fontsize=16, fontproperties=prop)
+                    ax.set_ylabel("総合スコア", fontsize=16, fontproperties=prop); ax.legend(prop=prop)
+                    for label in ax.get_xticklabels() + ax.get_yticklabels(): label.set_fontproperties(prop)
+                else:
+                    ax.set_title(f"[{selected_disease_group}] Trajectory Overlay"); ax.set_xlabel("Days since ICU admission"); ax.set_ylabel("Total Score"); ax.legend()
+                ax.set_ylim(0, 105); ax.grid(True, linestyle='--', alpha=0.6); st.pyplot(fig)
+            if selected_active_patient != "比較しない":
+                st.write("---"); st.subheader("類似した過去の患者")
+                st.info("総合スコアと7つの要因スコアについて、入室からここまでの経過が近い退室済患者を表示します。その後の経過や退室時転帰を見通しの参考にできます。")
+                same_group_only = st.checkbox("同じ疾患群の患者に限定する", value=True)
+                similarity_index = get_similarity_index(facility_id, cold_version)
+                similar = find_similar_patients(similarity_index, current_patient_df, selected_disease_group if same_group_only else None)
+                if similar.empty: st.info("経過を比較できる退室済患者がまだいません。")
+                else:
+                    st.dataframe(similar, hide_index=True)
+                    if use_client_charts(): st.vega_lite_chart(build_similar_patients_spec(similarity_index, similar, selected_active_patient, current_patient_df), width="stretch")
+                    else: st.pyplot(create_similar_patients_chart(similarity_index, similar, selected_active_patient, current_patient_df))
+            st.write("---"); st.subheader("回復速度の可視化（日次スコア変化の平均）")
+            st.info("このグラフは、スコアが1日あたり平均してどれくらい変化したかを示しています。正の値が大きいほど回復の勢いが強く、負の値は状態の悪化を示唆します。回復が加速・停滞するタイミングを分析できます。")
+            if not group_df.empty:
+                if use_client_charts(): st.vega_lite_chart(build_recovery_speed_spec(average_speed, selected_disease_group), width="stretch")
+                else:
+                    fig_speed = Figure(figsize=(10, 5)); ax_speed = fig_speed.add_subplot()
+                    average_speed.plot(kind='bar', ax=ax_speed, color=['skyblue' if x >= 0 else 'salmon' for x in average_speed.values])
+                    ax_speed.axhline(0, color='grey', linewidth=0.8)
+                    if prop:
+                        ax_speed.set_title(f"【{selected_disease_group}】回復速度", fontsize=16, fontproperties=prop); ax_speed.set_xlabel("ICU入室後経過日数", fontsize=16, fontproperties=prop)
+                        ax_speed.set_ylabel("前日からの平均スコア変化量", fontsize=16, fontproperties=prop)
+                        for label in ax_speed.get_xticklabels() + ax_speed.get_yticklabels(): label.set_fontproperties(prop)
+                    else:
+                        ax_speed.set_title(f"[{selected_disease_group}] Recovery Speed"); ax_speed.set_xlabel("Days since ICU admission"); ax_speed.set_ylabel("Avg. Daily Score Change")
+                    ax_speed.grid(True, axis='y', linestyle='--', alpha=0.6); st.pyplot(fig_speed)
+    else: st.info("分析対象の疾患群がデータにありません。")
+
+@st.fragment
+def render_phase_summary_tab(facility_id, cold_version):
+    """統計ダッシュボード「数値サマリー」タブ（依存データ: 施設の退室済患者 @ cold_version）"""
+    archived_df_dashboard = get_archived_view(facility_id, cold_version)
+    st.subheader("各フェーズの滞在日数の分布")
+    st.info("この箱ひげ図は、各フェーズに滞在した日数の分布を疾患群ごとに比較しています。箱の長さが短いほど日数のばらつきが少なく、治療期間が安定していることを示唆します。治療が長引きやすいフェーズの特定に役立ちます。")
+    days_in_phase = archived_df_dashboard.groupby(['アプリ用患者ID', '疾患群', 'フェーズ'], observed=False).size().reset_index(name='勤務帯の数')
+    days_in_phase['日数'] = days_in_phase['勤務帯の数'] / 2.0
+    if use_client_charts(): st.vega_lite_chart(build_phase_days_spec(days_in_phase), width="stretch")
+    else:
+        fig = Figure(figsize=(12, 7)); ax = fig.add_subplot()
+        sns.boxplot(data=days_in_phase, x='疾患群', y='日数', hue='フェーズ', ax=ax)
+        if prop:
+            ax.set_title("疾患群ごとのフェーズ別滞在日数", fontsize=16, fontproperties=prop); ax.set_xlabel("疾患群", fontsize=16, fontproperties=prop)
+            ax.set_ylabel("滞在日数", fontsize=16, fontproperties=prop); legend = ax.legend(prop=prop, title='フェーズ'); plt.setp(legend.get_title(), fontproperties=prop)
+            for label in ax.get_xticklabels() + ax.get_yticklabels(): label.set_fontproperties(prop)
+        else:
+            ax.set_title("Days in Each Phase per Disease Group"); ax.set_xlabel("Disease Group"); ax.set_ylabel("Days"); ax.legend(title='Phase')
+        plt.setp(ax.get_xticklabels(), rotation=30, ha='right'); st.pyplot(fig)
+    st.write("---"); st.subheader("重要指標サマリー")
+    st.info("以下の表は、疾患群ごとの主要な臨床指標をまとめたものです。日数は「中央値 [四分位範囲]」、率は「パーセント (該当者数/全体数)」で表示しています。")
+    patient_counts = archived_df_dashboard.groupby('疾患群')['アプリ用患者ID'].nunique()
+    los_per_patient = archived_df_dashboard.groupby('アプリ用患者ID')['経過日数'].max()
+    patient_to_group = archived_df_dashboard.drop_duplicates(subset='アプリ用患者ID').set_index('アプリ用患者ID')['疾患群']
+    los_df = pd.DataFrame({'ICU滞在日数': los_per_patient, '疾患群': patient_to_group}); grouped_los = los_df.groupby('疾患群')['ICU滞在日数']
+    median_los = grouped_los.median(); q1_los = grouped_los.quantile(0.25); q3_los = grouped_los.quantile(0.75)
+    milestone_events = MILESTONE_EVENTS; milestone_results = {}
+    for event in milestone_events:
+        event_df = archived_df_dashboard[archived_df_dashboard['イベント'].fillna('').str.split(r'\s*,\s*', regex=True).apply(lambda x: event in x)]
+        days_to_event = event_df.groupby('アプリ用患者ID')['経過日数'].min()
+        event_days_df = pd.merge(days_to_event, patient_to_group, on='アプリ用患者ID'); grouped_event_days = event_days_df.groupby('疾患群')['経過日数']
+        milestone_results[event] = {"median": grouped_event_days.median(), "q1": grouped_event_days.quantile(0.25), "q3": grouped_event_days.quantile(0.75)}
+    complication_events = COMPLICATION_EVENTS; complication_results = {}
+    for event in complication_events:
+        patients_with_event = archived_df_dashboard[archived_df_dashboard['イベント'].fillna('').str.split(r'\s*,\s*', regex=True).apply(lambda x: event in x)]['アプリ用患者ID'].unique()
+        complication_rates = patient_to_group.to_frame().groupby('疾患群').apply(lambda g: pd.Series({'count': len([pid for pid in patients_with_event if pid in g.index]), 'total': len(g), 'rate': len([pid for pid in patients_with_event if pid in g.index]) / len(g) * 100 if len(g) > 0 else 0}), include_groups=False)
+        complication_results[event] = complication_rates
+    disease_groups = archived_df_dashboard['疾患群'].dropna().unique()
+    index_names = ["患者数 (人)", "ICU総滞在日数 (中央値 [IQR])"] + [f"{e}までの日数 (中央値 [IQR])" for e in milestone_events] + [f"{e} 経験率 (%)" for e in complication_events]
+    summary_df = pd.DataFrame(index=index_names, columns=disease_groups)
+    for group in disease_groups:
+        summary_df.loc["患者数 (人)", group] = f"{patient_counts.get(group, 0)}"
+        los_text = f"{median_los.get(group, 0):.1f} [{q1_los.get(group, 0):.1f} - {q3_los.get(group, 0):.1f}]"
+        summary_df.loc["ICU総滞在日数 (中央値 [IQR])", group] = los_text
+        for event in milestone_events:
+            median = milestone_results[event]['median'].get(group)
+            if pd.notna(median):
+                q1 = milestone_results[event]['q1'].get(group); q3 = milestone_results[event]['q3'].get(group)
+                summary_df.loc[f"{event}までの日数 (中央値 [IQR])", group] = f"{median:.1f} [{q1:.1f} - {q3:.1f}]"
+        for event in complication_events:
+            result_for_event = complication_results[event]
+            if not result_for_event.empty and group in result_for_event.index:
+                rate_info = result_for_event.loc[group]
+                summary_df.loc[f"{event} 経験率 (%)", group] = f"{rate_info['rate']:.1f} ({int(rate_info['count'])}/{int(rate_info['total'])})"
+    st.dataframe(summary_df.fillna("-"))
+
 def run_app():
     st.set_page_config(layout="wide")
     st.markdown("""
@@ -159,121 +1322,30 @@ def run_app():
         
         if facility_id != st.secrets.get("master_credentials", {}).get("id", "master_admin_fallback"):
             if 'df' not in st.session_state or st.session_state.get('current_facility') != facility_id:
-                st.session_state.df = load_data(DATA_FILE)
-                st.session_state.df['ステータス'] = st.session_state.df['ステータス'].fillna('在室中')
+                checkout_data(facility_id, DATA_FILE)
                 st.session_state.current_facility = facility_id
+                # 作業ファイルに残っている退室済の患者は、コールド領域へ移してから使う
+                if (st.session_state.df['ステータス'] == '退室済').any() and not st.session_state.get("trial_mode"):
+                    def migrate_archived(df):
+                        legacy_archived = df['ステータス'] == '退室済'
+                        if legacy_archived.any(): archive_patients_to_cold(facility_id, df[legacy_archived])
+                        return df[~legacy_archived].reset_index(drop=True)
+                    modify_data(DATA_FILE, migrate_archived)
         
         patient_id_to_use = None
     
         # --- サイドバー ---
         with st.sidebar:
             st.header(f"施設ID: {facility_id}")
+            render_precompute_status(facility_id)
+            st.toggle("グラフをブラウザで描画する", key="client_charts", help="グラフを画像ではなくデータとして送り、お使いの端末で描画します。サーバーの負荷が軽くなり、拡大や値の確認もできます。")
             if facility_id != st.secrets.get("master_credentials", {}).get("id", "master_admin_fallback"):
                 st.subheader("患者選択")
                 active_patients = sorted(st.session_state.df[st.session_state.df['ステータス'] == '在室中']['アプリ用患者ID'].unique()) if not st.session_state.df.empty else []
                 selected_patient = st.selectbox("表示・記録する患者IDを選択", options=["新しい患者を登録..."] + active_patients)
                 patient_id_to_use = st.text_input("新しいアプリ用患者IDを入力してください") if selected_patient == "新しい患者を登録..." else selected_patient
                 if patient_id_to_use:
-                    st.subheader("データ入力・修正"); st.write(f"**対象患者:** {patient_id_to_use}")
-                    record_date = st.date_input("日付", datetime.date.today())
-                    
-                    if not st.session_state.get("trial_mode"):
-                        if record_date > datetime.date.today(): st.error("未来の日付は入力できません。"); st.stop()
-                    
-                    time_of_day = st.selectbox("時間帯", options=["朝", "夕"])
-                    default_values = {name: 10 for name in FACTOR_SCORE_NAMES}; default_values["総合スコア"] = 10; default_values["イベント"] = ""
-                    patient_df = st.session_state.df[st.session_state.df['アプリ用患者ID'] == patient_id_to_use]
-                    if not patient_df.empty:
-                        latest_disease_group = patient_df.sort_values(by="日付", ascending=False).iloc[0]['疾患群']
-                        default_values["疾患群"] = latest_disease_group if pd.notna(latest_disease_group) else DISEASE_OPTIONS[0]
-                    else: default_values["疾患群"] = DISEASE_OPTIONS[0]
-                    existing_data = patient_df[(patient_df['日付'] == str(record_date)) & (patient_df['時間帯'] == time_of_day)]
-                    if not existing_data.empty:
-                        record = existing_data.iloc[0].to_dict()
-                        for col, val in record.items():
-                            if pd.notna(val) and col in default_values: default_values[col] = val
-                    else:
-                        patient_df_copy = patient_df.copy()
-                        if not patient_df_copy.empty:
-                            patient_df_copy['日付'] = pd.to_datetime(patient_df_copy['日付'])
-                            patient_df_copy['プロット用日時'] = patient_df_copy.apply(lambda row: row['日付'].replace(hour=8 if row['時間帯'] == '朝' else 20), axis=1)
-                            current_selection_dt = pd.to_datetime(str(record_date)).replace(hour=8 if time_of_day == '朝' else 20)
-                            previous_records = patient_df_copy[patient_df_copy['プロット用日時'] < current_selection_dt]
-                            if not previous_records.empty:
-                                last_record = previous_records.sort_values(by='プロット用日時').iloc[-1].to_dict()
-                                for col, val in last_record.items():
-                                    if pd.notna(val) and col in default_values and col != 'イベント': default_values[col] = val
-                    disease_group_index = DISEASE_OPTIONS.index(default_values["疾患群"]) if default_values["疾患群"] in DISEASE_OPTIONS else 3
-                    disease_group_select = st.selectbox("疾患群を選択", options=DISEASE_OPTIONS, index=disease_group_index)
-                    disease_group = st.text_input("疾患群を自由記載", value=default_values["疾患群"]) if disease_group_select == "その他（自由記載）" else disease_group_select
-                    st.write("---"); st.write("**多職種スコア入力**")
-                    guidelines = {
-                        "循環スコア": "- **0-19:** 昇圧薬(高用量) or 補助循環(ECMO/Impella)導入 or 致死的不整脈\n- **20-39:** 昇圧薬(中等量) or 補助循環化に安定\n- **40-59:** 昇圧薬(少量) or 補助循環weaning\n- **60-89:** 昇圧薬離脱 or 補助循環終了\n- **90-100:** 循環動態が安定",
-                        "呼吸スコア": "- **0-19:** 高い呼吸器設定、筋弛緩使用\n- **20-39:** 自発呼吸モード、低い呼吸器設定、非挿管だが頻呼吸\n- **40-59:** SBT成功～抜管\n- **60-89:** 抜管～HFNC/NPPV離脱\n- **90-100:** 経鼻酸素～酸素なしで安定",
-                        "意識_鎮静スコア": "- **0-19:** 深い鎮静(RASS-4~-5) or 意識障害\n- **20-39:** 浅い鎮静(RASS-1~-3) or せん妄\n- **40-59:** SAT成功\n- **60-89:** 会話可能 or 良好な筆談\n- **90-100:** 意識清明、良好な睡眠",
-                        "腎_体液スコア": "- **0-19:** 大量輸液・輸血が必要\n- **20-39:** 大量輸液は不要だが除水はできず\n- **40-59:** バランス±0～-500mL/dayほどの緩徐なマイナスバランス\n- **60-89:** refilling、積極的な除水\n- **90-100:** 適正体重への除水達成",
-                        "活動_リハスコア": "- **0-19:** 体位変換にも制限、ROM訓練のみ\n- **20-39:** ベッド上安静（ギャッジアップなど）\n- **40-59:** 端座位達成\n- **60-89:** 立位達成\n- **90-100:** 室内歩行開始",
-                        "栄養_消化管スコア": "- **0-19:** 絶食、消化管トラブルあり\n- **20-39:** 経腸栄養(少量)開始\n- **40-59:** 経腸栄養を増量中\n- **60-89:** 目標カロリー達成、経口摂取開始\n- **90-100:** 経口摂取が自立",
-                        "感染_炎症スコア": "- **0-19:** 敗血症性ショック\n- **20-39:** マーカー高値だがIL-6、PCT peak out\n- **40-59:** 解熱、CRPもpeak out\n- **60-89:** 抗菌薬のDe-escalation済み、CRP<10mg/dL\n- **90-100:** 抗菌薬終了、炎症反応正常化"
-                    }
-                    factor_scores = {}; selected_events_map = {}
-                    score_event_map = {"循環スコア": "#循環", "呼吸スコア": "#呼吸", "意識_鎮静スコア": "#意識/鎮静", "腎_体液スコア": "#腎/体液", "活動_リハスコア": "#活動/リハ", "栄養_消化管スコア": "#栄養/消化管", "感染_炎症スコア": "#感染/炎症"}
-                    default_event_list = [e.strip() for e in default_values.get("イベント", "").split(',')] if default_values.get("イベント", "") else []
-                    for score_name, category in score_event_map.items():
-                        col1, col2 = st.columns([0.85, 0.15])
-                        with col1: factor_scores[score_name] = create_score_input(score_name, default_values.get(score_name, 10), score_name)
-                        with col2: st.popover("❓", help="スコアリングの目安").markdown(guidelines[score_name])
-                        category_events = [event for event, props in EVENT_FLAGS.items() if props.get("category") == category]
-                        default_category_events = [e for e in default_event_list if e in category_events]
-                        selected_events_map[score_name] = st.multiselect(f"{score_name} 関連イベント", options=category_events, default=default_category_events, key=f"{score_name}_events")
-                        if st.button(f"【{score_name}】と関連イベントのみ記録", key=f"save_{score_name}"):
-                            record_index = st.session_state.df[(st.session_state.df['アプリ用患者ID'] == patient_id_to_use) & (st.session_state.df['日付'] == str(record_date)) & (st.session_state.df['時間帯'] == time_of_day)].index
-                            if record_index.empty:
-                                new_record = {"アプリ用患者ID": patient_id_to_use, "日付": str(record_date), "時間帯": time_of_day}
-                                st.session_state.df = pd.concat([st.session_state.df, pd.DataFrame([new_record])], ignore_index=True)
-                                record_index = st.session_state.df.tail(1).index
-                            st.session_state.df.loc[record_index, score_name] = factor_scores[score_name]
-                            other_events = [e for e in default_event_list if e not in category_events]
-                            current_events = selected_events_map[score_name]
-                            all_events_str = ", ".join(sorted(list(set(other_events + current_events))))
-                            st.session_state.df.loc[record_index, 'イベント'] = all_events_str
-                            st.session_state.df.to_csv(DATA_FILE, index=False)
-                            st.success(f"{score_name}と関連イベントを記録しました！"); st.rerun()
-                        st.write("---")
-                    st.write("**ICU医師 最終判断**"); total_score = create_score_input("総合スコア", default_values.get("総合スコア", 10), "total_score")
-                    if st.button("【総合スコア】のみ記録", key="save_total_score"):
-                        record_index = st.session_state.df[(st.session_state.df['アプリ用患者ID'] == patient_id_to_use) & (st.session_state.df['日付'] == str(record_date)) & (st.session_state.df['時間帯'] == time_of_day)].index
-                        if record_index.empty:
-                            new_record = {"アプリ用患者ID": patient_id_to_use, "日付": str(record_date), "時間帯": time_of_day, "総合スコア": total_score}
-                            st.session_state.df = pd.concat([st.session_state.df, pd.DataFrame([new_record])], ignore_index=True)
-                        else: st.session_state.df.loc[record_index, "総合スコア"] = total_score
-                        st.session_state.df.to_csv(DATA_FILE, index=False)
-                        st.success("総合スコアを記録しました！"); st.rerun()
-                    general_events_options = [event for event, props in EVENT_FLAGS.items() if props.get("category") == "#その他"]
-                    default_general_events = [e for e in default_event_list if e in general_events_options]
-                    selected_general_events = st.multiselect("その他イベント", options=general_events_options, default=default_general_events, key="general_events")
-                    if st.button("【総合スコアと全項目】を一括で記録・修正する", type="primary"):
-                        all_selected_events = selected_general_events
-                        for score_name in score_event_map: all_selected_events.extend(selected_events_map[score_name])
-                        event_text = ", ".join(sorted(list(set(all_selected_events))))
-                        previous_total_score = None
-                        if not existing_data.empty:
-                            patient_df_copy = patient_df.copy(); patient_df_copy['日付'] = pd.to_datetime(patient_df_copy['日付'])
-                            patient_df_copy['プロット用日時'] = patient_df_copy.apply(lambda row: row['日付'].replace(hour=8 if row['時間帯'] == '朝' else 20), axis=1)
-                            current_selection_dt = pd.to_datetime(str(record_date)).replace(hour=8 if time_of_day == '朝' else 20)
-                            previous_records = patient_df_copy[patient_df_copy['プロット用日時'] < current_selection_dt]
-                            if not previous_records.empty: previous_total_score = previous_records.sort_values(by='プロット用日時').iloc[-1]['総合スコア']
-                        else: previous_total_score = default_values.get("総合スコア")
-                        if previous_total_score is not None and pd.notna(previous_total_score):
-                            if abs(total_score - previous_total_score) >= 41: st.warning(f"注意：スコアが前回({int(previous_total_score)}点)から41点以上変動しています。内容を確認してください。")
-                        new_data_dict = {"アプリ用患者ID": patient_id_to_use, "日付": str(record_date), "時間帯": time_of_day, "総合スコア": total_score, "イベント": event_text, "ステータス": "在室中", "疾患群": disease_group}; new_data_dict.update(factor_scores)
-                        st.session_state.df = st.session_state.df.drop_duplicates(subset=['アプリ用患者ID', '日付', '時間帯'], keep='last')
-                        record_index = st.session_state.df[(st.session_state.df['アプリ用患者ID'] == patient_id_to_use) & (st.session_state.df['日付'] == str(record_date)) & (st.session_state.df['時間帯'] == time_of_day)].index
-                        if not record_index.empty: st.session_state.df.update(pd.DataFrame(new_data_dict, index=record_index))
-                        else: st.session_state.df = pd.concat([st.session_state.df, pd.DataFrame([new_data_dict])], ignore_index=True)
-                        st.session_state.df = st.session_state.df.sort_values(by=["アプリ用患者ID", "日付", "時間帯"]); st.session_state.df.to_csv(DATA_FILE, index=False)
-                        LOG_FILE = f"{LOG_FILE_PREFIX}{facility_id}.csv"; write_log(LOG_FILE, facility_id, patient_id_to_use, "データ一括記録/修正")
-                        st.success("全項目を記録しました！"); st.rerun()
+                    render_input_form(facility_id, patient_id_to_use, DATA_FILE)
             st.write("---")
             if st.button("ログアウト"):
                 for key in list(st.session_state.keys()): del st.session_state[key]
@@ -284,17 +1356,25 @@ def run_app():
             st.write("全施設のアーカイブデータを表示・管理します。")
             
             all_files = glob.glob(f"{DATA_FILE_PREFIX}*.csv")
-            if not all_files:
+            cold_months = list_cold_months()
+            if not all_files and not cold_months:
                 st.info("データファイルが見つかりません。")
             else:
-                all_archived_dfs = []
+                all_archived_dfs = []; all_facility_dfs = []
                 for f in all_files:
                     df_temp = load_data(f)
-                    archived = df_temp[df_temp['ステータス'] == '退室済']
+                    facility_name = os.path.basename(f).replace(DATA_FILE_PREFIX, '').replace('.csv', '')
+                    all_facility_dfs.append(df_temp.assign(施設ID=facility_name))
+                    archived = df_temp[df_temp['ステータス'] == '退室済']  # まだコールド領域へ移されていない施設の分
                     if not archived.empty:
-                        facility_name = os.path.basename(f).replace(DATA_FILE_PREFIX, '').replace('.csv', '')
                         archived.insert(0, '施設ID', facility_name)
                         all_archived_dfs.append(archived)
+                if cold_months:
+                    selected_months = st.multiselect("表示する月（空欄ならすべて）", options=cold_months, default=cold_months[-3:])
+                    cold_archived = load_archived_data(filters=[("month", "in", selected_months)] if selected_months else None)
+                    if not cold_archived.empty:
+                        cold_archived = cold_archived.drop(columns=['month']).rename(columns={'facility_id': '施設ID'})
+                        all_archived_dfs.append(cold_archived[['施設ID'] + [c for c in cold_archived.columns if c != '施設ID']])
                 
                 if all_archived_dfs:
                     master_df = pd.concat(all_archived_dfs, ignore_index=True)
@@ -303,129 +1383,32 @@ def run_app():
                     st.download_button("全アーカイブデータをCSVでダウンロード", csv_master, 'master_archived_data.csv', 'text/csv')
                 else:
                     st.info("アーカイブされたデータを持つ施設はありません。")
-        else:
-            if patient_id_to_use:
-                display_df = st.session_state.df[st.session_state.df['アプリ用患者ID'] == patient_id_to_use].copy()
-                display_df = calculate_derived_columns(display_df)
-                
-                if not display_df.empty:
-                    st.header(f"患者: {patient_id_to_use}")
-                    latest_record_main = display_df.sort_values(by="日付", ascending=False).iloc[0]
-                    st.markdown(f"#### **疾患群:** {latest_record_main['疾患群']}")
-                    st.write("---")
-
-                    col1, col2 = st.columns([1, 2])
-                    with col1:
-                        available_dates = sorted(pd.to_datetime(display_df['日付']).dt.date.unique(), reverse=True)
-                        selected_date = st.selectbox("日付を選択", options=available_dates, format_func=lambda d: d.strftime('%Y-%m-%d'))
-                    with col2:
-                        times_on_date = display_df[pd.to_datetime(display_df['日付']).dt.date == selected_date]['時間帯'].unique()
-                        index_val = 1 if "夕" in times_on_date and len(times_on_date) > 1 else 0
-                        selected_time = st.radio("時間帯を選択", ["朝", "夕"], horizontal=True, index=index_val)
-                    
-                    df_sorted = display_df.sort_values(by='プロット用日時').reset_index(drop=True)
-                    current_index = df_sorted.index[(df_sorted['日付'].dt.date == selected_date) & (df_sorted['時間帯'] == selected_time)].tolist()
-                    
-                    if current_index:
-                        current_idx = current_index[0]
-                        current_record = df_sorted.iloc[current_idx]
-                        previous_record = df_sorted.iloc[current_idx - 1] if current_idx > 0 else None
-                        
-                        st.subheader("スコアサマリー")
-                        cols_metric = st.columns(2)
-                        with cols_metric[0]:
-                            if previous_record is not None:
-                                phase_color = PHASE_COLORS.get(previous_record['フェーズ'], '#888')
-                                score_display = int(previous_record["総合スコア"]) if pd.notna(previous_record["総合スコア"]) else "-"
-                                st.markdown(f'<div class="metric-container"> <div style="font-size: 14px; color: #888;">前回 ({previous_record["日付"].strftime("%m/%d")} {previous_record["時間帯"]})</div> <div style="font-size: 32px; font-weight: bold; color: #333;">{score_display}</div> <div style="font-size: 18px; font-weight: bold; color: {phase_color};">{previous_record["フェーズ"]}</div> </div>', unsafe_allow_html=True)
-                            else:
-                                st.info("比較対象の前回データがありません。")
-                        with cols_metric[1]:
-                            phase_color = PHASE_COLORS.get(current_record['フェーズ'], '#888')
-                            score_display = int(current_record["総合スコア"]) if pd.notna(current_record["総合スコア"]) else "-"
-                            st.markdown(f'<div class="metric-container"> <div style="font-size: 14px; color: #888;">今回 ({current_record["日付"].strftime("%m/%d")} {current_record["時間帯"]})</div> <div style="font-size: 32px; font-weight: bold; color: #1f497d;">{score_display}</div> <div style="font-size: 18px; font-weight: bold; color: {phase_color};">{current_record["フェーズ"]}</div> </div>', unsafe_allow_html=True)
-                        
-                        st.write("---")
-                        st.subheader("コンディションサマリー（比較）")
-                        current_data = current_record[FACTOR_SCORE_NAMES].to_dict()
-                        previous_data = previous_record[FACTOR_SCORE_NAMES].to_dict() if previous_record is not None else None
-                        current_label, previous_label, current_color, previous_color, current_style, previous_style = ("当日 夕", "当日 朝", 'red', 'blue', '-', '-') if selected_time == '夕' else ("当日 朝", "前日 夕", 'blue', 'red', '-', '--')
-                        fig_radar = create_radar_chart(labels=FACTOR_SCORE_NAMES, current_data=current_data, previous_data=previous_data, current_label=current_label, previous_label=previous_label, current_color=current_color, previous_color=previous_color, current_style=current_style, previous_style=previous_style)
-                        st.pyplot(fig_radar)
-                    else:
-                        st.info(f"{selected_date.strftime('%Y-%m-%d')} {selected_time} のデータはありません。")
-                    
-                    st.write("---")
-                st.subheader("軌跡シート")
-                df_graph = display_df.copy()
-                if not df_graph.empty:
-                    st.write("---")
-                    # 総合スコアがNaNでない行だけをプロット対象とする
-                    plot_df = df_graph.dropna(subset=['総合スコア']).copy()
-
-                    fig, ax = plt.subplots(figsize=(12, 7))
-
-                    # 総合スコアが存在する点だけを結んだ線グラフを描画
-                    if not plot_df.empty:
-                        ax.plot(plot_df['プロット用日時'], pd.to_numeric(plot_df['総合スコア'], errors='coerce'), 
-                                marker='o', linestyle='-', markersize=8, zorder=10)
-
-                    # イベントのプロット（これは全データを対象に行う）
-                    events_to_plot = df_graph.dropna(subset=['イベント'])
-                    for _, row in events_to_plot.iterrows():
-                        event_string, plot_time, plot_score = row['イベント'], row['プロット用日時'], pd.to_numeric(row['総合スコア'], errors='coerce')
-                        if pd.isna(plot_score) or not event_string: continue
-
-                        events = [e.strip() for e in event_string.split(',')]
-                        first_event_flag = EVENT_FLAGS.get(events[0])
-
-                        if first_event_flag:
-                            ax.scatter(plot_time, plot_score, color=first_event_flag['color'], marker=first_event_flag['marker'], s=200, zorder=12)
-
-                        vertical_offset = 10
-                        for event in events:
-                            flag = EVENT_FLAGS.get(event)
-                            if flag and prop:
-                                ax.text(plot_time, plot_score + vertical_offset, f" {event} ", 
-                                        ha='center', va='bottom',
-                                        bbox=dict(boxstyle='round,pad=0.2', fc=flag['color'], alpha=0.7),
-                                        fontproperties=prop)
-                                vertical_offset += 10
-
-                    # X軸の設定（全体の期間を正しく反映させる）
-                    ax.xaxis.set_major_locator(mdates.DayLocator(interval=1))
-                    ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
-                    fig.autofmt_xdate(rotation=30)
-
-                    # グラフのスタイル設定
-                    ax.set_ylim(-5, 105); ax.grid(True, axis='y', linestyle='--', alpha=0.6)
-                    if prop:
-                        ax.set_title("治療フェーズの軌跡", fontsize=20, pad=20, fontproperties=prop)
-                        ax.set_ylabel("総合スコア", fontsize=16, fontproperties=prop)
-                        ax.set_xlabel("日付", fontsize=16, fontproperties=prop)
-                        for label in ax.get_xticklabels() + ax.get_yticklabels():
-                            label.set_fontproperties(prop)
-                            label.set_fontsize(16)
-
-                        bbox_style = dict(boxstyle='round,pad=0.4', fc='white', ec='none', alpha=0.85)
-                        ax.axhspan(0, 20, color=PHASE_COLORS["超急性期"], alpha=0.3)
-                        ax.axhspan(20, 60, color=PHASE_COLORS["維持期"], alpha=0.3)
-                        ax.axhspan(60, 90, color=PHASE_COLORS["回復期"], alpha=0.3)
-                        ax.axhspan(80, 100, color=PHASE_COLORS["転棟期"], alpha=0.3)
-                        ax.text(0.02, 0.1, "超急性期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
-                        ax.text(0.02, 0.4, "維持期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
-                        ax.text(0.02, 0.7, "回復期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
-                        ax.text(0.02, 0.9, "転棟期", fontsize=18, transform=ax.transAxes, bbox=bbox_style, fontproperties=prop)
-                    else:
-                        ax.set_title("Trajectory Sheet", fontsize=20, pad=20)
-                        ax.set_ylabel("Score", fontsize=16)
-                        ax.set_xlabel("Date", fontsize=16)
-                        ax.tick_params(axis='both', which='major', labelsize=16)
 
-                    plt.tight_layout(pad=2.0)
-                    st.pyplot(fig)                
-                else:
-                    st.info(f"「{patient_id_to_use}」さんのデータはまだありません。")
+                cold_facilities = list_cold_facilities()
+                if cold_facilities:
+                    st.write("---"); st.subheader("全施設の重要指標サマリー")
+                    st.info("各施設が退室時に積み上げている疾患群ごとの集計を合算しています。日数は「中央値 [四分位範囲]」、率は「パーセント (該当者数/全体数)」で表示しています。")
+                    selected_facilities = st.multiselect("集計する施設", options=cold_facilities, default=cold_facilities)
+                    merged_summary = reduce(merge_summaries, [load_facility_summary(f) for f in selected_facilities], {})
+                    if merged_summary: st.dataframe(build_summary_table(merged_summary))
+                    else: st.info("集計できる退室済患者のデータがありません。")
+
+                st.write("---"); st.subheader("全施設のデータ品質チェック")
+                if st.checkbox("スコア急変・勤務帯の欠落・重複・値域外を検出する"):
+                    all_versions = tuple((f, get_file_version(f)) for f in sorted(all_files)) + (get_cold_version(),)
+                    all_cold_dfs = load_archived_data().drop(columns=['month']).rename(columns={'facility_id': '施設ID'})
+                    anomalies = scan_data_anomalies(pd.concat(all_facility_dfs + [all_cold_dfs], ignore_index=True), all_versions)
+                    if anomalies.empty: st.success("問題は見つかりませんでした。")
+                    else:
+                        st.write(f"#### 要確認の記録: {len(anomalies)}件"); st.write(anomalies.groupby(['施設ID', '種別']).size().unstack(fill_value=0))
+                        st.dataframe(anomalies, hide_index=True)
+        else:
+            data_version = st.session_state.get('data_version', 0)
+            if st.toggle("病棟一覧モード（在室中の全患者の軌跡を一覧表示）"):
+                render_ward_overview(facility_id, data_version)
+            elif patient_id_to_use:
+                render_patient_summary(facility_id, patient_id_to_use, data_version)
+                render_trajectory(facility_id, patient_id_to_use, data_version)
             else:
                 st.info("サイドバーで患者を選択または新規登録してください。")
             
@@ -436,154 +1419,73 @@ def run_app():
                 if st.button(f"{patient_id_to_use} を退室済（アーカイブ）にする"):
                     if selected_outcome:
                         if st.session_state.get("trial_mode"):
-                            st.session_state.df = st.session_state.df[st.session_state.df['アプリ用患者ID'] != patient_id_to_use]
+                            modify_data(DATA_FILE, lambda df: df[df['アプリ用患者ID'] != patient_id_to_use].reset_index(drop=True))  # 共有の最新データからも消す
                             st.success(f"【お試しモード】{patient_id_to_use} さんのデータは破棄されました。")
                         else:
-                            patient_indices = st.session_state.df[st.session_state.df['アプリ用患者ID'] == patient_id_to_use].index
-                            if not patient_indices.empty:
-                                last_index = patient_indices[-1]; st.session_state.df.loc[last_index, '退室時転帰'] = selected_outcome
-                            st.session_state.df.loc[st.session_state.df['アプリ用患者ID'] == patient_id_to_use, 'ステータス'] = '退室済'
-                            st.session_state.df.to_csv(DATA_FILE, index=False)
+                            def archive_patient(df):  # 他の端末の保存を含む最新データに対して操作する
+                                patient_rows = df['アプリ用患者ID'] == patient_id_to_use
+                                if patient_rows.any(): df.loc[df.index[patient_rows][-1], '退室時転帰'] = selected_outcome
+                                df.loc[patient_rows, 'ステータス'] = '退室済'
+                                if patient_rows.any(): archive_patients_to_cold(facility_id, df[patient_rows])
+                                return df[~patient_rows].reset_index(drop=True)
+                            modify_data(DATA_FILE, archive_patient)
                             st.success(f"{patient_id_to_use} さんを「{selected_outcome}」としてアーカイブしました。")
                         st.rerun()
                     else:
                         st.warning("退室時転帰を選択してください。")
 
+            if st.checkbox("データ品質チェック（スコア急変・勤務帯の欠落・重複・値域外）を表示"):
+                facility_all_df = pd.concat([st.session_state.df, load_archived_data(facility_id).drop(columns=['month'])], ignore_index=True)
+                anomalies = scan_data_anomalies(facility_all_df, (facility_id, st.session_state.get('data_version'), get_cold_version(facility_id)))
+                if anomalies.empty: st.success("問題は見つかりませんでした。")
+                else:
+                    st.write(f"#### 要確認の記録: {len(anomalies)}件"); st.write(anomalies['種別'].value_counts().to_frame('件数').T)
+                    st.dataframe(anomalies, hide_index=True)
+
             show_archive = st.checkbox("アーカイブされた患者を表示")
             if show_archive:
-                archived_df = st.session_state.df[st.session_state.df['ステータス'] == '退室済']; st.write("#### 退室済（アーカイブ）患者一覧"); st.dataframe(archived_df); st.write("---")
+                archived_df = load_archived_data(facility_id).drop(columns=['month']); st.write("#### 退室済（アーカイブ）患者一覧"); st.dataframe(archived_df); st.write("---")
                 for patient_id in sorted(archived_df['アプリ用患者ID'].unique()):
                     col1, col2 = st.columns([4, 1])
                     with col1: st.write(f"**患者ID:** {patient_id}")
                     with col2:
                         if st.button("在室中に戻す", key=f"reactivate_{patient_id}", use_container_width=True):
-                            st.session_state.df.loc[st.session_state.df['アプリ用患者ID'] == patient_id, 'ステータス'] = '在室中'
-                            st.session_state.df.to_csv(DATA_FILE, index=False); st.success(f"{patient_id}さんを在室中に戻しました。"); st.rerun()
+                            def reactivate_patient(df, patient_id=patient_id):
+                                restored_df = read_cold_patient(facility_id, patient_id).assign(ステータス='在室中')
+                                delete_cold_patient(facility_id, patient_id)  # 先に消しておき、保存後の事前計算に古いアーカイブが混ざらないようにする
+                                return pd.concat([df, restored_df], ignore_index=True).sort_values(by=["アプリ用患者ID", "日付", "時間帯"])
+                            modify_data(DATA_FILE, reactivate_patient, patient_id); st.success(f"{patient_id}さんを在室中に戻しました。"); st.rerun()
             
             if not st.session_state.get("trial_mode"):
                 st.write("---"); st.subheader("データのエクスポート")
-                csv_patient_data = st.session_state.df.to_csv(index=False).encode('utf-8-sig')
-                st.download_button(label="患者データをCSVでダウンロード", data=csv_patient_data, file_name=f"patient_data_{facility_id}_{datetime.date.today()}.csv", mime='text/csv')
+                # CSVはボタンを押したときにだけ作る（再実行のたびに全アーカイブを読み込まない）
+                hot_df = st.session_state.df
+                export_patient_data = lambda: pd.concat([hot_df, read_cold_partitions(facility_id).drop(columns=['month'])], ignore_index=True).to_csv(index=False).encode('utf-8-sig')
+                st.download_button(label="患者データをCSVでダウンロード", data=export_patient_data, file_name=f"patient_data_{facility_id}_{datetime.date.today()}.csv", mime='text/csv', on_click="ignore")
                 LOG_FILE = f"{LOG_FILE_PREFIX}{facility_id}.csv"
                 if os.path.exists(LOG_FILE):
-                    with open(LOG_FILE, "rb") as file: st.download_button(label="操作ログをCSVでダウンロード", data=file, file_name=f"log_data_{facility_id}_{datetime.date.today()}.csv", mime='text/csv')
+                    def export_log():
+                        with open(LOG_FILE, "rb") as file: return file.read()
+                    st.download_button(label="操作ログをCSVでダウンロード", data=export_log, file_name=f"log_data_{facility_id}_{datetime.date.today()}.csv", mime='text/csv', on_click="ignore")
 
             st.write("---"); st.header("統計ダッシュボード")
-                    # ★★★ ここから修正 ★★★
-        if st.session_state.get("trial_mode"):
-            st.info("現在はお試しモードです。統計ダッシュボードのサンプルが表示されています。")
-            # ここでサンプル画像などを表示できます。
-            st.image("統計ダッシュボードサンプル1.png")
-            st.image("統計ダッシュボードサンプル2.png")
-            st.image("統計ダッシュボードサンプル3.png")
-            st.image("統計ダッシュボードサンプル4.png")
-        else:
-            # 通常モードの場合、既存のダッシュボードロジックを実行
-            archived_df_dashboard = st.session_state.df[st.session_state.df['ステータス'] == '退室済'].copy()
-            archived_df_dashboard = calculate_derived_columns(archived_df_dashboard)
-            archived_df_dashboard['プロット用経過日数'] = archived_df_dashboard.apply(lambda row: row['経過日数'] + 0.5 if row['時間帯'] == '夕' else row['経過日数'], axis=1)
-            if archived_df_dashboard.empty: st.info("分析対象となる、アーカイブされた患者データがまだありません。")
+            if st.session_state.get("trial_mode"):
+                st.info("現在はお試しモードです。統計ダッシュボードのサンプルが表示されています。")
+                # ここでサンプル画像などを表示できます。
+                st.image("統計ダッシュボードサンプル1.png")
+                st.image("統計ダッシュボードサンプル2.png")
+                st.image("統計ダッシュボードサンプル3.png")
+                st.image("統計ダッシュボードサンプル4.png")
             else:
-                with st.expander("ダッシュボードを表示する", expanded=True):
-                    tab1, tab2 = st.tabs(["軌跡の比較", "数値サマリー"])
-                    with tab1:
-                        st.subheader("治療軌跡の重ね合わせプロット")
-                        st.info("このグラフは、選択された疾患群の全患者の回復曲線（半透明の線）と、その平均軌跡（赤線）を示しています。これにより、その疾患の典型的な回復パターンと、個々の患者のばらつきを視覚的に把握できます。")
-                        disease_groups = archived_df_dashboard['疾患群'].dropna().unique()
-                        if len(disease_groups) > 0:
-                            selected_disease_group = st.selectbox("分析したい疾患群を選択してください", options=disease_groups)
-                            if selected_disease_group:
-                                active_df = st.session_state.df[st.session_state.df['ステータス'] == '在室中'].copy(); active_df = calculate_derived_columns(active_df)
-                                active_df['プロット用経過日数'] = active_df.apply(lambda row: row['経過日数'] + 0.5 if row['時間帯'] == '夕' else row['経過日数'], axis=1)
-                                active_patients_in_group = active_df[active_df['疾患群'] == selected_disease_group]['アプリ用患者ID'].unique()
-                                selected_active_patient = st.selectbox("比較したい治療中の患者を選択（任意）", options=["比較しない"] + list(active_patients_in_group))
-                                group_df = archived_df_dashboard[archived_df_dashboard['疾患群'] == selected_disease_group]; patient_ids = group_df['アプリ用患者ID'].unique()
-                                fig, ax = plt.subplots(figsize=(10, 6))
-                                for patient_id in patient_ids:
-                                    patient_df = group_df[group_df['アプリ用患者ID'] == patient_id]; patient_df = patient_df.sort_values(by='プロット用日時')
-                                    ax.plot(patient_df['プロット用経過日数'], pd.to_numeric(patient_df['総合スコア'], errors='coerce'), marker='o', linestyle='-', alpha=0.3, label='_nolegend_')
-                                if not group_df.empty:
-                                    mean_trajectory = group_df.groupby('プロット用経過日数')['総合スコア'].mean().reset_index()
-                                    ax.plot(mean_trajectory['プロット用経過日数'], mean_trajectory['総合スコア'], marker='o', linestyle='-', linewidth=3, color='red', label=f'{selected_disease_group} 平均')
-                                if selected_active_patient != "比較しない":
-                                    current_patient_df = active_df[active_df['アプリ用患者ID'] == selected_active_patient]; current_patient_df = current_patient_df.sort_values(by='プロット用日時')
-                                    ax.plot(current_patient_df['プロット用経過日数'], pd.to_numeric(current_patient_df['総合スコア'], errors='coerce'), marker='o', linestyle='-', linewidth=3, color='springgreen', label=f'治療中: {selected_active_patient}', zorder=15)
-                                if prop:
-                                    ax.set_title(f"【{selected_disease_group}】治療軌跡の重ね合わせ", fontsize=16, fontproperties=prop); ax.set_xlabel("ICU入室後経過日数", fontsize=16, fontproperties=prop)
-                                    ax.set_ylabel("総合スコア", fontsize=16, fontproperties=prop); ax.legend(prop=prop)
-                                    for label in ax.get_xticklabels() + ax.get_yticklabels(): label.set_fontproperties(prop)
-                                else:
-                                    ax.set_title(f"[{selected_disease_group}] Trajectory Overlay"); ax.set_xlabel("Days since ICU admission"); ax.set_ylabel("Total Score"); ax.legend()
-                                ax.set_ylim(0, 105); ax.grid(True, linestyle='--', alpha=0.6); st.pyplot(fig)
-                                st.write("---"); st.subheader("回復速度の可視化（日次スコア変化の平均）")
-                                st.info("このグラフは、スコアが1日あたり平均してどれくらい変化したかを示しています。正の値が大きいほど回復の勢いが強く、負の値は状態の悪化を示唆します。回復が加速・停滞するタイミングを分析できます。")
-                                all_changes = []
-                                for patient_id in patient_ids:
-                                    patient_df = group_df[group_df['アプリ用患者ID'] == patient_id].copy(); patient_df = patient_df.sort_values(by='プロット用日時')
-                                    patient_df['スコア変化量'] = pd.to_numeric(patient_df['総合スコア'], errors='coerce').diff(); all_changes.append(patient_df[['経過日数', 'スコア変化量']])
-                                if all_changes:
-                                    all_changes_df = pd.concat(all_changes); average_speed = all_changes_df.groupby('経過日数')['スコア変化量'].mean()
-                                    fig_speed, ax_speed = plt.subplots(figsize=(10, 5))
-                                    average_speed.plot(kind='bar', ax=ax_speed, color=['skyblue' if x >= 0 else 'salmon' for x in average_speed.values])
-                                    ax_speed.axhline(0, color='grey', linewidth=0.8)
-                                    if prop:
-                                        ax_speed.set_title(f"【{selected_disease_group}】回復速度", fontsize=16, fontproperties=prop); ax_speed.set_xlabel("ICU入室後経過日数", fontsize=16, fontproperties=prop)
-                                        ax_speed.set_ylabel("前日からの平均スコア変化量", fontsize=16, fontproperties=prop)
-                                        for label in ax_speed.get_xticklabels() + ax_speed.get_yticklabels(): label.set_fontproperties(prop)
-                                    else:
-                                        ax_speed.set_title(f"[{selected_disease_group}] Recovery Speed"); ax_speed.set_xlabel("Days since ICU admission"); ax.set_ylabel("Avg. Daily Score Change")
-                                    ax_speed.grid(True, axis='y', linestyle='--', alpha=0.6); st.pyplot(fig_speed)
-                        else: st.info("分析対象の疾患群がデータにありません。")
-                    with tab2:
-                        st.subheader("各フェーズの滞在日数の分布")
-                        st.info("この箱ひげ図は、各フェーズに滞在した日数の分布を疾患群ごとに比較しています。箱の長さが短いほど日数のばらつきが少なく、治療期間が安定していることを示唆します。治療が長引きやすいフェーズの特定に役立ちます。")
-                        days_in_phase = archived_df_dashboard.groupby(['アプリ用患者ID', '疾患群', 'フェーズ'], observed=False).size().reset_index(name='勤務帯の数')
-                        days_in_phase['日数'] = days_in_phase['勤務帯の数'] / 2.0
-                        fig, ax = plt.subplots(figsize=(12, 7))
-                        sns.boxplot(data=days_in_phase, x='疾患群', y='日数', hue='フェーズ', ax=ax)
-                        if prop:
-                            ax.set_title("疾患群ごとのフェーズ別滞在日数", fontsize=16, fontproperties=prop); ax.set_xlabel("疾患群", fontsize=16, fontproperties=prop)
-                            ax.set_ylabel("滞在日数", fontsize=16, fontproperties=prop); legend = ax.legend(prop=prop, title='フェーズ'); plt.setp(legend.get_title(), fontproperties=prop)
-                            for label in ax.get_xticklabels() + ax.get_yticklabels(): label.set_fontproperties(prop)
-                        else:
-                            ax.set_title("Days in Each Phase per Disease Group"); ax.set_xlabel("Disease Group"); ax.set_ylabel("Days"); ax.legend(title='Phase')
-                        plt.xticks(rotation=30, ha='right'); st.pyplot(fig)
-                        st.write("---"); st.subheader("重要指標サマリー")
-                        st.info("以下の表は、疾患群ごとの主要な臨床指標をまとめたものです。日数は「中央値 [四分位範囲]」、率は「パーセント (該当者数/全体数)」で表示しています。")
-                        patient_counts = archived_df_dashboard.groupby('疾患群')['アプリ用患者ID'].nunique()
-                        los_per_patient = archived_df_dashboard.groupby('アプリ用患者ID')['経過日数'].max()
-                        patient_to_group = archived_df_dashboard.drop_duplicates(subset='アプリ用患者ID').set_index('アプリ用患者ID')['疾患群']
-                        los_df = pd.DataFrame({'ICU滞在日数': los_per_patient, '疾患群': patient_to_group}); grouped_los = los_df.groupby('疾患群')['ICU滞在日数']
-                        median_los = grouped_los.median(); q1_los = grouped_los.quantile(0.25); q3_los = grouped_los.quantile(0.75)
-                        milestone_events = ["抜管", "SBT成功", "昇圧薬離脱", "補助循環離脱", "腎代替療法終了"]; milestone_results = {}
-                        for event in milestone_events:
-                            event_df = archived_df_dashboard[archived_df_dashboard['イベント'].fillna('').str.split(r'\s*,\s*', regex=True).apply(lambda x: event in x)]
-                            days_to_event = event_df.groupby('アプリ用患者ID')['経過日数'].min()
-                            event_days_df = pd.merge(days_to_event, patient_to_group, on='アプリ用患者ID'); grouped_event_days = event_days_df.groupby('疾患群')['経過日数']
-                            milestone_results[event] = {"median": grouped_event_days.median(), "q1": grouped_event_days.quantile(0.25), "q3": grouped_event_days.quantile(0.75)}
-                        complication_events = ["再挿管", "気管切開", "新規不整脈", "出血イベント", "せん妄", "新規感染症"]; complication_results = {}
-                        for event in complication_events:
-                            patients_with_event = archived_df_dashboard[archived_df_dashboard['イベント'].fillna('').str.split(r'\s*,\s*', regex=True).apply(lambda x: event in x)]['アプリ用患者ID'].unique()
-                            complication_rates = patient_to_group.to_frame().groupby('疾患群').apply(lambda g: pd.Series({'count': len([pid for pid in patients_with_event if pid in g.index]), 'total': len(g), 'rate': len([pid for pid in patients_with_event if pid in g.index]) / len(g) * 100 if len(g) > 0 else 0}), include_groups=False)
-                            complication_results[event] = complication_rates
-                        disease_groups = archived_df_dashboard['疾患群'].dropna().unique()
-                        index_names = ["患者数 (人)", "ICU総滞在日数 (中央値 [IQR])"] + [f"{e}までの日数 (中央値 [IQR])" for e in milestone_events] + [f"{e} 経験率 (%)" for e in complication_events]
-                        summary_df = pd.DataFrame(index=index_names, columns=disease_groups)
-                        for group in disease_groups:
-                            summary_df.loc["患者数 (人)", group] = f"{patient_counts.get(group, 0)}"
-                            los_text = f"{median_los.get(group, 0):.1f} [{q1_los.get(group, 0):.1f} - {q3_los.get(group, 0):.1f}]"
-                            summary_df.loc["ICU総滞在日数 (中央値 [IQR])", group] = los_text
-                            for event in milestone_events:
-                                median = milestone_results[event]['median'].get(group)
-                                if pd.notna(median):
-                                    q1 = milestone_results[event]['q1'].get(group); q3 = milestone_results[event]['q3'].get(group)
-                                    summary_df.loc[f"{event}までの日数 (中央値 [IQR])", group] = f"{median:.1f} [{q1:.1f} - {q3:.1f}]"
-                            for event in complication_events:
-                                result_for_event = complication_results[event]
-                                if not result_for_event.empty and group in result_for_event.index:
-                                    rate_info = result_for_event.loc[group]
-                                    summary_df.loc[f"{event} 経験率 (%)", group] = f"{rate_info['rate']:.1f} ({int(rate_info['count'])}/{int(rate_info['total'])})"
-                        st.dataframe(summary_df.fillna("-"))
+                # 通常モードの場合、既存のダッシュボードロジックを実行
+                cold_version = get_cold_version(facility_id)
+                archived_df_dashboard = get_archived_view(facility_id, cold_version)
+                if archived_df_dashboard.empty: st.info("分析対象となる、アーカイブされた患者データがまだありません。")
+                else:
+                    with st.expander("ダッシュボードを表示する", expanded=True):
+                        tab1, tab2 = st.tabs(["軌跡の比較", "数値サマリー"])
+                        with tab1: render_trajectory_comparison_tab(facility_id, data_version, cold_version)
+                        with tab2: render_phase_summary_tab(facility_id, cold_version)
 
 if __name__ == "__main__":
     run_app()
\ No newline at end of file